@@ -0,0 +1,34 @@
+""" Benchmark the import time of pipeline modules in fresh interpreters """
+
+from __future__ import division, print_function
+import os
+import subprocess
+import sys
+
+MODULES = ['preprocess.imdb', 'preprocess.pagviews', 'preprocess.sentiment',
+           'models', 'predict', 'run_preprocess']
+REPEAT = 5
+
+TIMER = ('import time; t0 = time.time(); import %s; '
+         'print(time.time() - t0)')
+
+
+def import_time(module, repeat=REPEAT):
+    """ Median seconds to import `module` in a new interpreter """
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            out = subprocess.check_output(
+                [sys.executable, '-c', TIMER % module], stderr=devnull)
+            times.append(float(out.split()[-1]))
+    return sorted(times)[len(times) // 2]
+
+
+def main():
+    modules = sys.argv[1:] or MODULES
+    for m in modules:
+        print('%-22s %8.3fs' % (m, import_time(m)))
+
+
+if __name__ == '__main__':
+    main()
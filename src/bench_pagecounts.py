@@ -0,0 +1,82 @@
+""" Benchmark raw pagecounts readers in lines per second """
+
+from __future__ import division, print_function
+import gzip
+import os
+import random
+import shutil
+import sys
+import tempfile
+from time import time
+
+from filter_pagviews import load_wiki_titles, read_fun_generator, WIKI_TITLES
+from pagecounts import TitleMatcher, read_matching_lines
+
+PROJECTS = ['de', 'en', 'en.b', 'es', 'fr', 'ja', 'ru', 'zh']
+N_LINES = 2000000
+
+
+def make_sample(path, titles, n_lines=N_LINES, hit_rate=0.001):
+    """ Write a synthetic, project-sorted pagecounts gzip """
+    random.seed(123)
+    per_project = n_lines // len(PROJECTS)
+    titles = [t.encode('latin-1', 'ignore') for t in titles]
+    with gzip.open(path, 'wb') as fo:
+        for p in PROJECTS:
+            lines = []
+            for i in range(per_project):
+                if random.random() < hit_rate:
+                    t = random.choice(titles)
+                else:
+                    t = b'Article_' + str(i).encode('ascii')
+                lines.append(b' '.join([p.encode('ascii'), t, b'1', b'4096']))
+            fo.write(b'\n'.join(sorted(lines)) + b'\n')
+
+
+def bench(name, fn, path):
+    t0 = time()
+    n_lines, n_hits = fn(path)
+    dt = time() - t0
+    print('%-12s %10d lines %8d hits %8.2fs %12.0f lines/s'
+          % (name, n_lines, n_hits, dt, n_lines / dt))
+
+
+def run_generator(matcher):
+    def fn(path):
+        n_lines, n_hits = 0, 0
+        for line in read_fun_generator(path):
+            n_lines += 1
+            if matcher.match(line):
+                n_hits += 1
+        return n_lines, n_hits
+    return fn
+
+
+def run_blocks(matcher, n_lines, sorted_input=False):
+    def fn(path):
+        lines = read_matching_lines(path, matcher, sorted_input=sorted_input)
+        return n_lines, sum(1 for _ in lines)
+    return fn
+
+
+def main():
+    titles = load_wiki_titles(WIKI_TITLES)
+    matcher = TitleMatcher(titles)
+    folder = tempfile.mkdtemp()
+    try:
+        if len(sys.argv) > 1:
+            path = sys.argv[1]
+        else:
+            path = os.path.join(folder, 'pagecounts-20160101-000000.gz')
+            make_sample(path, titles)
+        with gzip.open(path, 'rb') as fi:
+            n_lines = sum(1 for _ in fi)
+        bench('generator', run_generator(matcher), path)
+        bench('blocks', run_blocks(matcher, n_lines), path)
+        bench('sorted', run_blocks(matcher, n_lines, True), path)
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
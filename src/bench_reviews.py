@@ -0,0 +1,49 @@
+""" Benchmark review page extractors in pages per second """
+
+from __future__ import division, print_function
+import os
+import sys
+from time import time
+
+from preprocess.imdb import EXTRACTORS
+
+REVIEWS_FOLDER = '../cache/reviews/'
+
+
+def gather_pages(folder):
+    paths = []
+    for root, _, fns in os.walk(folder):
+        paths.extend(os.path.join(root, fn) for fn in sorted(fns)
+                     if fn.endswith('.html'))
+    return paths
+
+
+def extract_all(name, paths):
+    extract = EXTRACTORS[name]
+    t0 = time()
+    pages = []
+    for p in paths:
+        movie, reviews = extract(p)
+        pages.append((movie, list(reviews)))
+    dt = time() - t0
+    print('%-6s %6d pages %8.2fs %10.1f pages/s'
+          % (name, len(paths), dt, len(paths) / dt))
+    return pages
+
+
+def main():
+    folder = sys.argv[1] if len(sys.argv) > 1 else REVIEWS_FOLDER
+    paths = gather_pages(folder)
+    if not paths:
+        print('No review pages in: %s' % folder)
+        return
+    results = dict((name, extract_all(name, paths)) for name in EXTRACTORS)
+    mismatches = [p for p, a, b in zip(paths, results['soup'], results['lxml'])
+                  if a != b]
+    print('%d/%d pages differ' % (len(mismatches), len(paths)))
+    for p in mismatches:
+        print('  %s' % p)
+
+
+if __name__ == '__main__':
+    main()
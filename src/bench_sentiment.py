@@ -0,0 +1,55 @@
+""" Benchmark review sentiment scorers and check the lexicon scorer against
+TextBlob. Exits with status 1 if the scores differ by more than TOLERANCE. """
+
+from __future__ import division, print_function
+import sys
+from time import time
+
+import numpy as np
+
+from bench_reviews import REVIEWS_FOLDER, gather_pages
+from preprocess.imdb import extract_reviews_lxml
+from preprocess.sentiment import SCORERS
+
+# Largest allowed mean absolute difference to TextBlob polarity, and share
+# of reviews allowed to differ by more than 0.1
+TOLERANCE = 0.01
+OUTLIERS = 0.02
+
+
+def review_texts(paths):
+    texts = []
+    for p in paths:
+        _, reviews = extract_reviews_lxml(p)
+        texts.extend(r.body for r in reviews)
+    return texts
+
+
+def score_all(name, texts):
+    scorer = SCORERS[name]()
+    t0 = time()
+    scores = scorer.score_many(texts)
+    dt = time() - t0
+    print('%-8s %7d reviews %8.2fs %10.1f reviews/s'
+          % (name, len(texts), dt, len(texts) / dt))
+    return scores
+
+
+def main():
+    folder = sys.argv[1] if len(sys.argv) > 1 else REVIEWS_FOLDER
+    texts = review_texts(gather_pages(folder))
+    if not texts:
+        print('No reviews in: %s' % folder)
+        return
+    results = dict((name, score_all(name, texts)) for name in SCORERS)
+    diff = np.abs(results['lexicon'] - results['textblob'])
+    outliers = (diff > 0.1).mean()
+    print('abs difference: mean %.4f  max %.4f  > 0.1: %.2f%%'
+          % (diff.mean(), diff.max(), 100 * outliers))
+    if diff.mean() > TOLERANCE or outliers > OUTLIERS:
+        print('Lexicon scores are out of tolerance')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
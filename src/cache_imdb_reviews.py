@@ -1,5 +1,6 @@
-""" Save review pages locally """
+""" Save review pages locally, as files or in a ReviewArchive """
 
+import argparse
 import json
 import logging
 import os
@@ -10,6 +11,8 @@ from bs4 import BeautifulSoup
 from selenium import webdriver
 from selenium.webdriver.support.ui import WebDriverWait
 
+from review_archive import ARCHIVE, ReviewArchive
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -21,20 +24,41 @@ PAUSE_VAR = 2
 PAGES = 'imdb-urls.json'
 
 
-def get_reviews(driver, begin_url, folder):
+def folder_saver(folder):
+    """ Save pages as `folder`/<page>.html """
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    def save(page, data):
+        out_path = folder + str(page) + '.html'
+        with open(out_path, 'wb') as fo:
+            fo.write(data)
+        return out_path
+    return save
+
+
+def archive_saver(archive, title):
+    """ Save pages in a ReviewArchive under `title` """
+    def save(page, data):
+        archive.write(title, page, data)
+        return '%s (%s)' % (archive.path, title)
+    return save
+
+
+def get_reviews(driver, begin_url, save):
     """
     Parameters
     ----------
     driver : webdriver
+    save : function saving a page from its page number and bytes, returns
+           where it was saved
     """
     xpaths = {'pages': '//*[@id="tn15content"]/table[1]/tbody/tr/td[1]/font'}
     pgs = driver.find_element_by_xpath(xpaths['pages']).text[:-1]
     cur_pg, max_pg = (int(pgs.split()[i]) for i in [1, 3])
     while cur_pg <= max_pg:
-        out_path = folder + str(cur_pg) + '.html'
-        with open(out_path, 'wb') as fo:
-            html = driver.page_source
-            fo.write(html.encode('utf-8'))
+        html = driver.page_source
+        out_path = save(cur_pg, html.encode('utf-8'))
         logger.info('Saved %s to: %s' % (pgs, out_path))
         if cur_pg < max_pg:
             sleep(PAUSE_VAR * random() + PAUSE_BASE)
@@ -47,11 +71,12 @@ def get_reviews(driver, begin_url, folder):
             break
 
 
-def process(driver):
+def process(driver, archive=None):
     """
     Parameters
     ----------
     driver : webdriver
+    archive : ReviewArchive to save pages in, instead of CACHE_FOLDER
     """
     logger.info('Loading urls from: %s' % PAGES)
     with open(PAGES, 'rb') as fi:
@@ -59,30 +84,40 @@ def process(driver):
     start_pages = start_pages
     for title in sorted(start_pages):
         sleep(PAUSE_VAR * random() + PAUSE_BASE)
-        folder = CACHE_FOLDER + title + '/'
-        if not os.path.exists(folder):
-            os.makedirs(folder)
+        if archive is None:
+            save = folder_saver(CACHE_FOLDER + title + '/')
+        else:
+            save = archive_saver(archive, title)
         url = start_pages[title]
         logger.info('Fetching: %s' % url)
         driver.get(url)
         soup = BeautifulSoup(driver.page_source, 'lxml')
         title = soup.title.text
         logger.info('Processing: %s' % title)
-        get_reviews(driver, url, folder)
+        get_reviews(driver, url, save)
 
 
-def main():
+def main(archive_path=None):
     t0 = time()
 
+    archive = None
+    if archive_path is not None:
+        archive = ReviewArchive(archive_path, 'a')
     driver = webdriver.Chrome(executable_path=DRIVER)
     driver.wait = WebDriverWait(driver, 10)
     try:
-        process(driver)
+        process(driver, archive)
     finally:
         driver.quit()
+        if archive is not None:
+            archive.close()
 
     tf = (time() - t0) / 60
     logger.info('--- %0.3f minutes ---' % tf)
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--archive', nargs='?', const=ARCHIVE,
+                        help='archive file, default: ' + ARCHIVE)
+    args = parser.parse_args()
+    main(args.archive)
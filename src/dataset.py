@@ -0,0 +1,94 @@
+""" Columnar on-disk format of the preprocessed dataset """
+
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+
+
+def save_dataset(data, path, settings=None):
+    """
+    Save a DataFrame as a folder with one file per column and a schema:
+
+        schema.json  format version, number of rows, columns and the
+                     feature settings that produced the data
+        col-NNN.npy  numeric and boolean columns, memory-mappable
+        col-NNN.json other columns, e.g. strings, with nulls as null
+
+    The folder is written under a temporary name and renamed into place.
+
+    Parameters
+    ----------
+    data : DataFrame
+    path : dataset folder
+    settings : JSON-serializable feature generation settings
+    """
+    tmp_path = path.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    columns = []
+    for i, name in enumerate(data.columns):
+        values = data[name].values
+        if values.dtype.kind in 'biufcmM':
+            fn = 'col-%03d.npy' % i
+            np.save(os.path.join(tmp_path, fn), values)
+        else:
+            fn = 'col-%03d.json' % i
+            with open(os.path.join(tmp_path, fn), 'w') as fo:
+                json.dump([None if pd.isnull(v) else v for v in values], fo)
+        columns.append({'name': name, 'file': fn, 'dtype': str(values.dtype)})
+    schema = {'version': VERSION, 'n_rows': len(data), 'columns': columns,
+              'settings': settings}
+    with open(os.path.join(tmp_path, 'schema.json'), 'w') as fo:
+        json.dump(schema, fo, indent=2, sort_keys=True)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    logger.info('Saved %d rows x %d columns to: %s'
+                % (len(data), len(columns), path))
+
+
+def load_schema(path):
+    with open(os.path.join(path, 'schema.json'), 'r') as fi:
+        schema = json.load(fi)
+    if schema['version'] != VERSION:
+        raise ValueError('Unsupported dataset version %s in: %s'
+                         % (schema['version'], path))
+    return schema
+
+
+def load_dataset(path, columns=None, mmap_mode='r'):
+    """
+    Load a dataset saved by `save_dataset`. Only the files of `columns`
+    are read, and .npy columns are memory-mapped with `mmap_mode`.
+
+    Parameters
+    ----------
+    path : dataset folder
+    columns : names of the columns to load, all columns by default
+    mmap_mode : see np.load, None to read the columns into memory
+    """
+    schema = load_schema(path)
+    files = dict((c['name'], c['file']) for c in schema['columns'])
+    if columns is None:
+        columns = [c['name'] for c in schema['columns']]
+    missing = [c for c in columns if c not in files]
+    if missing:
+        raise KeyError('Columns not in %s: %s' % (path, ', '.join(missing)))
+    data = {}
+    for name in columns:
+        fn = os.path.join(path, files[name])
+        if fn.endswith('.npy'):
+            data[name] = np.load(fn, mmap_mode=mmap_mode)
+        else:
+            with open(fn, 'r') as fi:
+                data[name] = np.array(json.load(fi), dtype=object)
+    return pd.DataFrame(data, columns=columns)
@@ -1,19 +1,37 @@
-""" Filter new hourly pageview count raw gzips and reduce to daily counts. """
+""" Filter new hourly pageview count raw gzips and reduce to daily counts.
+
+With --checkpoint, every raw file is filtered into its own gzip under
+HOURS_FOLDER and recorded in MANIFEST, so an interrupted run resumes where
+it stopped. Daily counts are then built with
+reduce_pageviews.count_views(sc, HOURS_FOLDER + '*.gz').
+"""
 
 from __future__ import division
+import argparse
 import fnmatch
 import json
 import gzip
 import logging
+from multiprocessing import Pool
 import os
+import shutil
 from time import time
 
 from tqdm import tqdm
 
+from pagecounts import (BatchWriter, Manifest, TitleMatcher,
+                        load_project_index, read_matching_lines,
+                        save_project_index)
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 CACHE_FILE = "../cache/pv/pageviews.gz"
+SHARDS_FOLDER = "../cache/pv/shards/"
+PROJECT_INDEX = "../cache/pv/project-index.json"
+HOURS_FOLDER = "../cache/pv/hours/"
+MANIFEST = "../cache/pv/manifest.txt"
+N_WORKERS = 1
 RAW_PAGEVIEWS_FOLDER = "/Volumes/TempDrive/pageviews/"
 WIKI_TITLES = "wiki_titles.json"
 
@@ -60,29 +78,162 @@ def gather_filepaths(folder, pattern='*'):
     return files
 
 
-def filter_raws(titles):
+def filter_file(path, matcher, fo, sorted_input=False, index=None):
+    """ Write the lines of one raw gzip accepted by `matcher` to `fo` """
+    n = 0
+    lines = read_matching_lines(path, matcher, sorted_input=sorted_input,
+                                index=index)
+    with BatchWriter(fo) as wr:
+        for line in tqdm(lines, leave=False):
+            wr.write(line)
+            n += 1
+    return n
+
+
+def _filter_shard(args):
+    shard_path, files, titles, sorted_input = args
+    matcher = TitleMatcher(titles)
+    n = 0
+    with gzip.open(shard_path, 'wb') as fo:
+        for f in files:
+            logger.info('Shard %s input: %s'
+                        % (os.path.basename(shard_path), os.path.basename(f)))
+            n += filter_file(f, matcher, fo, sorted_input)
+    return shard_path, n
+
+
+def filter_hour(path, matcher, sorted_input=False, index=None):
+    """
+    Filter one raw gzip into HOURS_FOLDER. The output is written to a
+    temporary file and renamed into place, so it is either complete or absent.
+    """
+    out_path = os.path.join(HOURS_FOLDER, os.path.basename(path))
+    tmp_path = '%s.%d.tmp' % (out_path, os.getpid())
+    with open(tmp_path, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as fo:
+            n = filter_file(path, matcher, fo, sorted_input, index)
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.rename(tmp_path, out_path)
+    return n
+
+
+_worker = {}
+
+
+def _init_hour_worker(titles, sorted_input):
+    _worker['matcher'] = TitleMatcher(titles)
+    _worker['sorted_input'] = sorted_input
+
+
+def _filter_hour(args):
+    path, index = args
+    n = filter_hour(path, _worker['matcher'], _worker['sorted_input'], index)
+    return path, n, index
+
+
+def filter_raws_checkpointed(titles, files, n_workers=N_WORKERS,
+                             sorted_input=False, index=None):
+    """
+    Filter each file not yet in MANIFEST into HOURS_FOLDER and record it in
+    the manifest once its output is in place. Input files are kept.
+    """
+    if not os.path.exists(HOURS_FOLDER):
+        os.makedirs(HOURS_FOLDER)
+    manifest = Manifest(MANIFEST)
+    todo = [f for f in files if os.path.basename(f) not in manifest]
+    logger.info('Skipping %d files already in: %s'
+                % (len(files) - len(todo), MANIFEST))
+    tasks = []
+    for f in todo:
+        fn = os.path.basename(f)
+        file_index = None
+        if index is not None:
+            file_index = {fn: index[fn]} if fn in index else {}
+        tasks.append((f, file_index))
+
+    if n_workers > 1:
+        pool = Pool(n_workers, _init_hour_worker, (titles, sorted_input))
+        results = pool.imap_unordered(_filter_hour, tasks)
+    else:
+        pool = None
+        _init_hour_worker(titles, sorted_input)
+        results = (_filter_hour(t) for t in tasks)
+    n = 0
+    try:
+        for i, (f, n_file, file_index) in enumerate(results, 1):
+            manifest.add(os.path.basename(f))
+            if file_index is not None:
+                index.update(file_index)
+            logger.info('Input %d/%d: %s (%d lines)'
+                        % (i, len(tasks), os.path.basename(f), n_file))
+            n += n_file
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return n
+
+
+def merge_shards(shard_paths, path):
+    """
+    Append gzipped shards to `path`. Concatenated gzip members form a valid
+    gzip stream, so shards are copied byte for byte without recompressing.
+    """
+    with open(path, 'ab') as fo:
+        for p in shard_paths:
+            with open(p, 'rb') as fi:
+                shutil.copyfileobj(fi, fo)
+            os.remove(p)
+    logger.info('Merged %d shards into: %s' % (len(shard_paths), path))
+
+
+def filter_raws(titles, n_workers=N_WORKERS, sorted_input=False,
+                use_index=False, checkpoint=False):
+    """
+    Parameters
+    ----------
+    titles : list of article titles to keep
+    n_workers : number of worker processes
+    sorted_input : stop scanning each file after its 'en' block
+    use_index : read and update the 'en' block offsets in PROJECT_INDEX,
+                only with `checkpoint`, as the offsets are of the input
+                files, which are otherwise deleted
+    checkpoint : write one output per input to HOURS_FOLDER, skip inputs
+                 already in MANIFEST and keep the input files
+    """
+    if use_index and not checkpoint:
+        raise ValueError('The project index needs the input files kept, '
+                         'use checkpoint mode')
     t0 = time()
-    prefixes = set([u'en ' + t for t in titles])
     folder = os.path.split(CACHE_FILE)[0]
     if not os.path.exists(folder):
         os.makedirs(folder)
-    n = 0
 
     pattern = 'pagecounts-*.gz'
     files = gather_filepaths(RAW_PAGEVIEWS_FOLDER, pattern)
     total = len(files)
     logger.info('Processing %d files..' % total)
-    fo = gzip.open(CACHE_FILE, 'ab')
-    i = 1
-    for f in files:
-        logger.info('Input %d/%d: %s' % (i, total, os.path.basename(f)))
-        for line in tqdm(read_fun_generator(f), leave=False):
-            if any([line.startswith(p) for p in prefixes]):
-                fo.write(line.encode('utf-8'))
-                fo.write('\n')
-                n += 1
-        i += 1
-    fo.close()
+    index = load_project_index(PROJECT_INDEX) if use_index else None
+    if checkpoint:
+        n = filter_raws_checkpointed(titles, files, n_workers, sorted_input,
+                                     index)
+        logger.info('Wrote %d lines to: %s' % (n, HOURS_FOLDER))
+        if index is not None:
+            save_project_index(index, PROJECT_INDEX)
+        tf = (time() - t0) / 60
+        logger.info('--- %0.3f minutes ---' % tf)
+        return
+    if n_workers > 1:
+        n = filter_raws_parallel(titles, files, n_workers, sorted_input)
+    else:
+        matcher = TitleMatcher(titles)
+        n = 0
+        with gzip.open(CACHE_FILE, 'ab') as fo:
+            for i, f in enumerate(files, 1):
+                logger.info('Input %d/%d: %s'
+                            % (i, total, os.path.basename(f)))
+                n += filter_file(f, matcher, fo, sorted_input)
     logger.info('Appended %d lines to: %s' % (n, CACHE_FILE))
 
     for f in files:
@@ -92,6 +243,47 @@ def filter_raws(titles):
     logger.info('--- %0.3f minutes ---' % tf)
 
 
+def filter_raws_parallel(titles, files, n_workers, sorted_input=False):
+    """
+    Filter `files` on a pool of `n_workers` processes. Each worker writes its
+    own gzipped shard, and the shards are merged into CACHE_FILE at the end.
+    """
+    if not os.path.exists(SHARDS_FOLDER):
+        os.makedirs(SHARDS_FOLDER)
+    tasks = []
+    for k in range(n_workers):
+        shard_files = files[k::n_workers]
+        if not shard_files:
+            continue
+        shard_path = os.path.join(SHARDS_FOLDER, 'pageviews-%03d.gz' % k)
+        tasks.append((shard_path, shard_files, titles, sorted_input))
+    if not tasks:
+        return 0
+    logger.info('Filtering on %d workers..' % len(tasks))
+    pool = Pool(min(n_workers, len(tasks)))
+    try:
+        results = pool.map(_filter_shard, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    merge_shards([p for p, _ in results], CACHE_FILE)
+    return sum(n for _, n in results)
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-w', '--workers', type=int, default=N_WORKERS,
+                        help='number of worker processes')
+    parser.add_argument('--sorted', action='store_true',
+                        help='raw files are sorted by project code')
+    parser.add_argument('--index', action='store_true',
+                        help='use saved project offsets: ' + PROJECT_INDEX +
+                             ' (with --checkpoint only)')
+    parser.add_argument('--checkpoint', action='store_true',
+                        help='resumable mode, see module docstring')
+    args = parser.parse_args()
+    if args.index and not args.checkpoint:
+        parser.error('--index needs --checkpoint, which keeps the inputs')
     titles = load_wiki_titles(WIKI_TITLES)
-    filter_raws(titles)
+    filter_raws(titles, n_workers=args.workers, sorted_input=args.sorted,
+                use_index=args.index, checkpoint=args.checkpoint)
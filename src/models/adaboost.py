@@ -1,6 +1,7 @@
 import logging
 
 from sklearn.ensemble import AdaBoostClassifier
+from sklearn.metrics import roc_auc_score
 from sklearn.tree import DecisionTreeClassifier
 
 from base import BaseClf
@@ -12,9 +13,15 @@ class Adaboost(BaseClf):
     def __init__(self):
         super(Adaboost, self).__init__()
         self.mdl = AdaBoostClassifier
+        self.staged = False
 
     def tune(self, X, y, max_depth=1, n_estimators=50, learning_rate=1.0,
-             n_jobs=1, verbose=0):
+             staged=False, n_jobs=1, verbose=0):
+        """
+        With `staged`, candidates differing only in n_estimators are fit
+        once per fold with the largest n_estimators, and every smaller one
+        is scored from the staged predictions of the first stages.
+        """
         if not isinstance(max_depth, list):
             max_depth = [max_depth]
         base_estimators = []
@@ -26,5 +33,29 @@ class Adaboost(BaseClf):
                        'learning_rate': learning_rate,
                        'random_state': 123}]
         param_grid = self.prep_param_grid(param_grid)
+        self.staged = staged
         return super(Adaboost, self).tune(X, y, param_grid,
                                           n_jobs=n_jobs, verbose=verbose)
+
+    def _group(self, candidates):
+        if not self.staged:
+            return super(Adaboost, self)._group(candidates)
+        return self._group_by_all_but(candidates, 'n_estimators')
+
+    def _evaluate(self, candidates, X, y, train, test):
+        if not self.staged:
+            return super(Adaboost, self)._evaluate(candidates, X, y,
+                                                   train, test)
+        n_estimators = max(p['n_estimators'] for p in candidates)
+        clf = self.mdl(**dict(candidates[0], n_estimators=n_estimators))
+        clf.fit(X[train], y[train])
+        # Boosting stops early on a perfect fit, and a larger n_estimators
+        # then gives the same ensemble
+        decisions = list(clf.staged_decision_function(X[test]))
+        probas = list(clf.staged_predict_proba(X[test]))
+        results = []
+        for params in candidates:
+            stage = min(params['n_estimators'], len(decisions)) - 1
+            results.append((roc_auc_score(y[test], decisions[stage]),
+                            probas[stage][:, 1]))
+        return results
@@ -2,16 +2,19 @@ from collections import namedtuple
 import logging
 from time import time
 
-import matplotlib.pyplot as plt
 import numpy as np
 from scipy import interp
 from sklearn.cross_validation import StratifiedKFold
-from sklearn.grid_search import GridSearchCV
-from sklearn.metrics import roc_curve, auc
+from sklearn.externals.joblib import Parallel, delayed
+from sklearn.grid_search import ParameterGrid
+from sklearn.metrics import roc_auc_score, roc_curve, auc
 
 logger = logging.getLogger(__name__)
 
 MeanROC = namedtuple('MeanROC', ['mean_fpr', 'mean_tpr', 'mean_auc'])
+# Same fields as the entries of GridSearchCV.grid_scores_
+CVScore = namedtuple('CVScore', ['parameters', 'mean_validation_score',
+                                 'cv_validation_scores'])
 
 
 def timed(f):
@@ -24,10 +27,30 @@ def timed(f):
     return timer
 
 
+def roc_auc(clf, X, y):
+    """
+    AUC of a fitted classifier, ranking by decision_function if it has one
+    and by predict_proba otherwise, like the 'roc_auc' scorer
+    """
+    try:
+        scores = clf.decision_function(X)
+    except (NotImplementedError, AttributeError):
+        scores = clf.predict_proba(X)[:, 1]
+    return roc_auc_score(y, scores)
+
+
+def _evaluate_fold(base, candidates, X, y, train, test):
+    return base._evaluate(candidates, X, y, train, test)
+
+
 class BaseClf(object):
     def __init__(self):
         self.clf = None
         self.mdl = None
+        self.grid_scores_ = None
+        self.best_params_ = None
+        self.best_score_ = None
+        self.oof_proba_ = None
 
     @staticmethod
     def cv(y, n_folds=3, shuffle=True, random_state=123):
@@ -43,15 +66,82 @@ class BaseClf(object):
                     grp[k] = [v]
         return param_grid
 
+    def _group(self, candidates):
+        """
+        Split the candidate parameter dicts into groups that `_evaluate`
+        fits together on each fold, one candidate per group by default
+        """
+        return [[params] for params in candidates]
+
+    @staticmethod
+    def _group_by_all_but(candidates, key):
+        """
+        Group candidates that only differ in parameter `key`, keeping the
+        order of the candidates within and across groups
+        """
+        groups = []
+        for params in candidates:
+            others = dict(params, **{key: None})
+            for group in groups:
+                if dict(group[0], **{key: None}) == others:
+                    group.append(params)
+                    break
+            else:
+                groups.append([params])
+        return groups
+
+    def _evaluate(self, candidates, X, y, train, test):
+        """
+        (AUC, positive class probabilities) on the `test` fold of each of a
+        group of candidates fitted on the `train` fold
+        """
+        results = []
+        for params in candidates:
+            clf = self.mdl(**params).fit(X[train], y[train])
+            results.append((roc_auc(clf, X[test], y[test]),
+                            clf.predict_proba(X[test])[:, 1]))
+        return results
+
     @timed
     def tune(self, X, y, param_grid, n_jobs=1, verbose=0):
-        logger.info("Grid searching (10-fold cv)")
-        self.clf = GridSearchCV(self.mdl(), param_grid=param_grid,
-                                n_jobs=n_jobs, cv=self.cv(y), verbose=verbose,
-                                scoring='roc_auc')
-        self.clf.fit(X, y)
+        """
+        Grid search with the semantics of GridSearchCV(scoring='roc_auc',
+        iid=True): a candidate scores the mean of its fold AUCs weighted by
+        fold size, and the first best candidate is refit on X, y. Groups of
+        candidates (see `_group`) and folds are evaluated on `n_jobs`
+        processes. The out-of-fold probabilities of the best candidate are
+        kept for `mean_roc`.
+        """
+        X, y = np.asarray(X), np.asarray(y)
+        folds = list(self.cv(y))
+        logger.info("Grid searching (%d-fold cv)" % len(folds))
+        candidates = list(ParameterGrid(param_grid))
+        groups = self._group(candidates)
+        out = Parallel(n_jobs=n_jobs, verbose=verbose)(
+            delayed(_evaluate_fold)(self, group, X, y, train, test)
+            for group in groups for train, test in folds)
+
+        fold_results = dict((id(params), []) for params in candidates)
+        out = iter(out)
+        for group in groups:
+            for _ in folds:
+                for params, result in zip(group, next(out)):
+                    fold_results[id(params)].append(result)
+        n_test = np.array([len(test) for _, test in folds])
+        self.grid_scores_ = []
+        for params in candidates:
+            scores = np.array([s for s, _ in fold_results[id(params)]])
+            mean_score = (scores * n_test).sum() / n_test.sum()
+            self.grid_scores_.append(CVScore(params, mean_score, scores))
+        best = int(np.argmax([s.mean_validation_score
+                              for s in self.grid_scores_]))
+        self.best_params_ = candidates[best]
+        self.best_score_ = self.grid_scores_[best].mean_validation_score
+        self.oof_proba_ = [(test, proba) for (_, test), (_, proba)
+                           in zip(folds, fold_results[id(candidates[best])])]
+        self.clf = self.mdl(**self.best_params_).fit(X, y)
         self.report_cv_scores()
-        return self.clf.best_params_
+        return self.best_params_
 
     def predict(self, X):
         return self.clf.predict(X)
@@ -61,49 +151,61 @@ class BaseClf(object):
 
     def report_cv_scores(self):
         logger.info("--- CV Scores ---")
-        for params, mean_cv_score, cv_scores in self.clf.grid_scores_:
+        for params, mean_cv_score, cv_scores in self.grid_scores_:
             logger.info("cv score: %0.5f (+/-%0.05f) for %r"
                         % (mean_cv_score, cv_scores.std() * 2, params))
 
         logger.info("--- Summary ---")
-        logger.info("Best parameters: %s" % self.clf.best_params_)
-        logger.info("Best cv score: %0.5f" % self.clf.best_score_)
+        logger.info("Best parameters: %s" % self.best_params_)
+        logger.info("Best cv score: %0.5f" % self.best_score_)
 
     def mean_roc(self, X, y, show_plot=False, **best_params_):
         """
         Based on tutorial at
         http://scikit-learn.org/stable/auto_examples/model_selection/plot_roc_crossval.html
+
+        The out-of-fold probabilities kept by `tune` are used if
+        `best_params_` are the tuned parameters, otherwise the folds are fit.
+        The curves are only plotted with `show_plot`, and matplotlib is only
+        imported then.
         """
-        clf = self.mdl(**best_params_)
-        cv = self.cv(y)
+        if show_plot:
+            import matplotlib.pyplot as plt
+        X, y = np.asarray(X), np.asarray(y)
+        if self.oof_proba_ is not None and best_params_ == self.best_params_:
+            folds = self.oof_proba_
+        else:
+            clf = self.mdl(**best_params_)
+            folds = [(test, clf.fit(X[train], y[train])
+                                .predict_proba(X[test])[:, 1])
+                     for train, test in self.cv(y)]
         mean_tpr = 0.0
         mean_fpr = np.linspace(0, 1, y.shape[0])
 
-        for i, (train, test) in enumerate(cv):
-            probas_ = clf.fit(X.ix[train], y.ix[train]).predict_proba(X.ix[test])
-            fpr, tpr, thresholds = roc_curve(y.ix[test], probas_[:, 1])
+        for i, (test, proba) in enumerate(folds):
+            fpr, tpr, thresholds = roc_curve(y[test], proba)
             mean_tpr += interp(mean_fpr, fpr, tpr)
             mean_tpr[0] = 0.0
-            roc_auc = auc(fpr, tpr)
-            plt.plot(fpr, tpr, lw=1, label='ROC fold %d (area = %0.2f)'
-                                           % (i, roc_auc))
-
-        plt.plot([0, 1], [0, 1], '--', color=(0.6, 0.6, 0.6), label='Luck')
+            if show_plot:
+                fold_auc = auc(fpr, tpr)
+                plt.plot(fpr, tpr, lw=1, label='ROC fold %d (area = %0.2f)'
+                                               % (i, fold_auc))
 
-        mean_tpr /= len(cv)
+        mean_tpr /= len(folds)
         mean_tpr[-1] = 1.0
         mean_auc = auc(mean_fpr, mean_tpr)
-        plt.plot(mean_fpr, mean_tpr, 'k--',
-                 label='Mean ROC (area = %0.2f)' % mean_auc, lw=2)
-
-        plt.xlim([-0.05, 1.05])
-        plt.ylim([-0.05, 1.05])
-        plt.xlabel('False Positive Rate')
-        plt.ylabel('True Positive Rate')
-        plt.title(self.__class__.__name__ +
-                  ': Receiver operating characteristic')
-        plt.legend(loc="lower right")
         if show_plot:
+            plt.plot([0, 1], [0, 1], '--', color=(0.6, 0.6, 0.6),
+                     label='Luck')
+            plt.plot(mean_fpr, mean_tpr, 'k--',
+                     label='Mean ROC (area = %0.2f)' % mean_auc, lw=2)
+            plt.xlim([-0.05, 1.05])
+            plt.ylim([-0.05, 1.05])
+            plt.xlabel('False Positive Rate')
+            plt.ylabel('True Positive Rate')
+            plt.title(self.__class__.__name__ +
+                      ': Receiver operating characteristic')
+            plt.legend(loc="lower right")
             plt.show()
         return MeanROC(mean_fpr, mean_tpr, mean_auc)
 
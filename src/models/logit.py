@@ -2,7 +2,7 @@ import logging
 
 from sklearn.linear_model import LogisticRegression
 
-from base import BaseClf
+from base import BaseClf, roc_auc
 
 logger = logging.getLogger(__name__)
 
@@ -11,12 +11,41 @@ class LogisticReg(BaseClf):
     def __init__(self):
         super(LogisticReg, self).__init__()
         self.mdl = LogisticRegression
+        self.path = False
 
     def tune(self, X, y, C=1.0, penalty='l1', class_weight=None,
-             n_jobs=1, verbose=0):
+             path=False, max_iter=1000, n_jobs=1, verbose=0):
+        """
+        With `path`, the models are fit with the saga solver along the
+        increasing C values of each penalty and class_weight on every fold,
+        each fit starting from the coefficients of the previous one.
+        `max_iter` is the saga iteration limit.
+        """
         param_grid = [{'C': C,
                        'penalty': penalty,
                        'class_weight': class_weight}]
+        if path:
+            param_grid[0].update({'solver': 'saga', 'max_iter': max_iter,
+                                  'random_state': 123})
         param_grid = self.prep_param_grid(param_grid)
+        self.path = path
         return super(LogisticReg, self).tune(X, y, param_grid,
                                              n_jobs=n_jobs, verbose=verbose)
+
+    def _group(self, candidates):
+        if not self.path:
+            return super(LogisticReg, self)._group(candidates)
+        return self._group_by_all_but(candidates, 'C')
+
+    def _evaluate(self, candidates, X, y, train, test):
+        if not self.path:
+            return super(LogisticReg, self)._evaluate(candidates, X, y,
+                                                      train, test)
+        clf = self.mdl(warm_start=True)
+        results = [None] * len(candidates)
+        for i in sorted(range(len(candidates)),
+                        key=lambda i: candidates[i]['C']):
+            clf.set_params(**candidates[i]).fit(X[train], y[train])
+            results[i] = (roc_auc(clf, X[test], y[test]),
+                          clf.predict_proba(X[test])[:, 1])
+        return results
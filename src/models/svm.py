@@ -1,19 +1,61 @@
 import logging
+import os
+import shutil
+import tempfile
 
+import numpy as np
+from sklearn.grid_search import ParameterGrid
+from sklearn.metrics.pairwise import pairwise_kernels
 from sklearn.svm import SVC
 
-from base import BaseClf
+from base import BaseClf, roc_auc
 
 logger = logging.getLogger(__name__)
 
+# Parameters used by each kernel, with the SVC defaults
+KERNEL_PARAMS = {'linear': (),
+                 'rbf': ('gamma',),
+                 'poly': ('gamma', 'degree', 'coef0'),
+                 'sigmoid': ('gamma', 'coef0')}
+KERNEL_DEFAULTS = {'kernel': 'rbf', 'gamma': 'auto', 'degree': 3,
+                   'coef0': 0.0}
+
+
+def kernel_setting(params):
+    """
+    (kernel, ((parameter, value), ...)) of the SVC parameters `params`,
+    leaving out the parameters the kernel does not use
+    """
+    kernel = params.get('kernel', KERNEL_DEFAULTS['kernel'])
+    return kernel, tuple((k, params.get(k, KERNEL_DEFAULTS[k]))
+                         for k in KERNEL_PARAMS[kernel])
+
+
+def gram_matrix(X, setting):
+    """ Kernel matrix of the rows of X for a `kernel_setting` """
+    kernel, kernel_params = setting
+    kernel_params = dict(kernel_params)
+    if kernel_params.get('gamma') == 'auto':
+        kernel_params['gamma'] = 1.0 / X.shape[1]
+    return pairwise_kernels(X, metric=kernel, **kernel_params)
+
 
 class SVM(BaseClf):
     def __init__(self):
         super(SVM, self).__init__()
         self.mdl = SVC
+        self.grams = None
 
     def tune(self, X, y, C=1.0, kernel='rbf', gamma='auto', class_weight=None,
-             degree=3, max_iter=-1, n_jobs=1, verbose=0):
+             degree=3, max_iter=-1, precomputed=False, n_jobs=1, verbose=0):
+        """
+        With `precomputed`, the Gram matrix of each kernel setting is
+        computed once on all of X and saved to a temporary folder, and every
+        C value and fold of the setting is fit on slices of it with
+        kernel='precomputed', one task per candidate and fold. The tasks
+        memory-map the matrix of their setting instead of receiving it. The
+        best parameters are refit with their kernel.
+        """
         param_grid = [{'C': C,
                        'kernel': kernel,
                        'gamma': gamma,
@@ -23,5 +65,37 @@ class SVM(BaseClf):
                        'probability': True,
                        'random_state': 123}]
         param_grid = self.prep_param_grid(param_grid)
-        return super(SVM, self).tune(X, y, param_grid,
-                                     n_jobs=n_jobs, verbose=verbose)
+        if not precomputed:
+            return super(SVM, self).tune(X, y, param_grid,
+                                         n_jobs=n_jobs, verbose=verbose)
+        X = np.asarray(X)
+        settings = set(kernel_setting(p) for p in ParameterGrid(param_grid))
+        logger.info("Computing %d Gram matrices" % len(settings))
+        folder = tempfile.mkdtemp(prefix='svm-grams-')
+        try:
+            # Gram matrix files by kernel setting
+            self.grams = {}
+            for i, setting in enumerate(settings):
+                path = os.path.join(folder, 'gram-%d.npy' % i)
+                np.save(path, gram_matrix(X, setting))
+                self.grams[setting] = path
+            return super(SVM, self).tune(X, y, param_grid,
+                                         n_jobs=n_jobs, verbose=verbose)
+        finally:
+            self.grams = None
+            shutil.rmtree(folder)
+
+    def _evaluate(self, candidates, X, y, train, test):
+        if self.grams is None:
+            return super(SVM, self)._evaluate(candidates, X, y, train, test)
+        results = []
+        for params in candidates:
+            gram = np.load(self.grams[kernel_setting(params)], mmap_mode='r')
+            gram_train = gram[np.ix_(train, train)]
+            gram_test = gram[np.ix_(test, train)]
+            params = dict((k, v) for k, v in params.items()
+                          if k not in KERNEL_DEFAULTS)
+            clf = SVC(kernel='precomputed', **params).fit(gram_train, y[train])
+            results.append((roc_auc(clf, gram_test, y[test]),
+                            clf.predict_proba(gram_test)[:, 1]))
+        return results
@@ -0,0 +1,328 @@
+""" Shared helpers for raw Wikipedia pagecounts dumps """
+
+from datetime import date, datetime
+import gzip
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 16 * 1024 * 1024
+BATCH_SIZE = 10000
+
+
+class TitleMatcher(object):
+    """
+    Match raw pagecounts lines against a set of article titles.
+
+    Raw lines look like:
+
+        en Argo_(2012_film) 63 3096234
+
+    The project and title fields are split out once and looked up in a
+    hash set, so the cost per line does not depend on how many titles
+    are tracked. `match` takes decoded lines and `match_bytes` takes the
+    undecoded latin-1 bytes of a dump.
+    """
+
+    def __init__(self, titles, project=u'en'):
+        self.project = project
+        self.titles = frozenset(titles)
+        self.raw_project = project.encode('latin-1')
+        raw_titles = []
+        for t in self.titles:
+            try:
+                raw_titles.append(t.encode('latin-1'))
+            except UnicodeEncodeError:
+                # Can never equal a latin-1 decoded line
+                continue
+        self.raw_titles = frozenset(raw_titles)
+
+    def match(self, line):
+        fields = line.split(u' ', 2)
+        return (len(fields) == 3 and fields[0] == self.project and
+                fields[1] in self.titles)
+
+    def match_bytes(self, line):
+        fields = line.split(b' ', 2)
+        return (len(fields) == 3 and fields[0] == self.raw_project and
+                fields[1] in self.raw_titles)
+
+    __call__ = match
+
+
+class BatchWriter(object):
+    """ Buffer lines and write them to `fo` in batches of `batch_size` """
+
+    def __init__(self, fo, batch_size=BATCH_SIZE):
+        self.fo = fo
+        self.batch_size = batch_size
+        self.batch = []
+
+    def write(self, line):
+        self.batch.append(line)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.fo.write(b'\n'.join(self.batch) + b'\n')
+            self.batch = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+
+def read_blocks(path, block_size=BLOCK_SIZE, start=0, stop=None):
+    """
+    Yield decompressed blocks of whole lines from a gzip file, optionally
+    limited to the decompressed byte range [start, stop).
+    """
+    tail = b''
+    with gzip.open(path, 'rb') as f:
+        if start:
+            f.seek(start)
+        remaining = None if stop is None else stop - start
+        while remaining is None or remaining > 0:
+            n = block_size if remaining is None else min(block_size, remaining)
+            block = f.read(n)
+            if not block:
+                break
+            if remaining is not None:
+                remaining -= len(block)
+            block = tail + block
+            end = block.rfind(b'\n') + 1
+            tail = block[end:]
+            if end:
+                yield block[:end]
+    if tail:
+        yield tail
+
+
+class Manifest(object):
+    """
+    Append-only record of finished input files, one file name per line.
+    Each entry is flushed and fsynced before `add` returns, so a name in
+    the manifest always refers to output that is already on disk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, 'r') as fi:
+                self.done.update(line.strip() for line in fi if line.strip())
+
+    def __contains__(self, filename):
+        return filename in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def add(self, filename):
+        with open(self.path, 'a') as fo:
+            fo.write(filename + '\n')
+            fo.flush()
+            os.fsync(fo.fileno())
+        self.done.add(filename)
+
+
+def load_project_index(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'rb') as fi:
+        return json.load(fi)
+
+
+def save_project_index(index, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fo:
+        json.dump(index, fo, sort_keys=True)
+    os.rename(tmp_path, path)
+    logger.info('Saved: %s' % path)
+
+
+def read_project_lines(path, project, block_size=BLOCK_SIZE, index=None):
+    """
+    Yield the lines of one project from a raw pagecounts gzip, relying on
+    the dumps being sorted by project code.
+
+    Blocks before the project are skipped with a substring search and the
+    scan stops at the first line past the project. If `index` is given,
+    the decompressed byte range of the project is recorded in it as
+    index[filename][project] = [start, stop], and a range already in the
+    index is read directly instead of scanned.
+    """
+    filename = os.path.basename(path)
+    span = index.get(filename, {}).get(project) if index is not None else None
+    if span is not None:
+        for block in read_blocks(path, block_size, *span):
+            for line in block.split(b'\n'):
+                if line:
+                    yield line
+        return
+
+    raw_project = project.encode('latin-1')
+    prefix = raw_project + b' '
+    offset = 0
+    start = stop = None
+    for block in read_blocks(path, block_size):
+        pos = 0
+        if start is None and not block.startswith(prefix):
+            pos = block.find(b'\n' + prefix) + 1
+            if not pos:
+                last = block.rstrip(b'\n').rsplit(b'\n', 1)[-1]
+                if last.split(b' ', 1)[0] < raw_project:
+                    offset += len(block)
+                    continue
+                # Passed the place of a project that is not in this file
+                start = stop = offset
+                break
+        if start is None:
+            start = offset + pos
+        cur = offset + pos
+        for line in block[pos:].split(b'\n'):
+            if line and not line.startswith(prefix):
+                stop = cur
+                break
+            if line:
+                yield line
+            cur += len(line) + 1
+        if stop is not None:
+            break
+        offset += len(block)
+    if start is None:
+        start = offset
+    if stop is None:
+        stop = offset
+    if index is not None:
+        index.setdefault(filename, {})[project] = [start, stop]
+
+
+def read_matching_lines(path, matcher, block_size=BLOCK_SIZE,
+                        sorted_input=False, index=None):
+    """
+    Yield the lines of a raw pagecounts gzip accepted by `matcher`, in the
+    same format as `read_fun_generator` but UTF-8 encoded, e.g.:
+
+        en Argo_(2012_film) 63 3096234|pagecounts-20160101-000000.gz
+
+    Lines are matched as raw bytes and only the matches are decoded and
+    tagged with the source file name. With `sorted_input` (or an `index`),
+    only the matcher's project block is scanned; see `read_project_lines`.
+    """
+    filename = os.path.basename(path)
+    if isinstance(filename, bytes):
+        filename = filename.decode('utf-8')
+    suffix = u'|' + filename
+    match = matcher.match_bytes
+    if sorted_input or index is not None:
+        lines = read_project_lines(path, matcher.project, block_size, index)
+    else:
+        lines = (line for block in read_blocks(path, block_size)
+                 for line in block.split(b'\n'))
+    for line in lines:
+        if match(line):
+            line = line.decode('latin-1').strip() + suffix
+            yield line.encode('utf-8')
+
+
+def parse_day(s):
+    """
+    Parse a YYYYMMDD day to a date ordinal. Invalid days such as 20150229
+    fall back to the previous valid day, as in PageViews.convert_dates.
+    """
+    s = str(s)
+    y, m, d = int(s[:4]), int(s[4:6]), int(s[6:])
+    while True:
+        try:
+            return date(y, m, d).toordinal()
+        except ValueError:
+            d -= 1
+
+
+class ViewsMatrix(object):
+    """
+    Views per day stored as a dense title x day int32 matrix.
+
+    A store is a folder with:
+
+        views.npy    int32 matrix, one row per title, one column per day
+        titles.json  row titles
+        meta.json    format version, first day and number of days
+
+    The matrix is memory-mapped, so opening a store only reads the small
+    index files and rows are paged in as they are sliced.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as fi:
+            meta = json.load(fi)
+        if meta['version'] != self.VERSION:
+            raise ValueError('Unsupported views matrix version %s in: %s'
+                             % (meta['version'], path))
+        self.first_day = meta['first_day']
+        self.n_days = meta['n_days']
+        with open(os.path.join(path, 'titles.json'), 'r') as fi:
+            self.titles = json.load(fi)
+        self.title_index = dict((t, i) for i, t in enumerate(self.titles))
+        self.views = np.load(os.path.join(path, 'views.npy'), mmap_mode='r')
+
+    @staticmethod
+    def is_store(path):
+        return os.path.exists(os.path.join(path, 'views.npy'))
+
+    def column(self, day):
+        """ Column of a date or date ordinal, may lie outside the matrix """
+        if hasattr(day, 'toordinal'):
+            day = day.toordinal()
+        return day - self.first_day
+
+    def day(self, column):
+        return datetime.fromordinal(self.first_day + column).date()
+
+    @classmethod
+    def save(cls, counts, path):
+        """
+        Write a store from (YYYYMMDD, title, views) triples. Triples for the
+        same day and title are summed. The store is built in a temporary
+        folder and renamed into place.
+        """
+        totals = {}
+        for day, title, views in counts:
+            key = (parse_day(day), title)
+            totals[key] = totals.get(key, 0) + int(views)
+        titles = sorted(set(t for _, t in totals))
+        title_index = dict((t, i) for i, t in enumerate(titles))
+        days = [d for d, _ in totals]
+        first_day = min(days) if days else 0
+        n_days = max(days) - first_day + 1 if days else 0
+
+        tmp_path = path.rstrip('/') + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        views = np.zeros((len(titles), n_days), dtype=np.int32)
+        for (d, t), v in totals.items():
+            views[title_index[t], d - first_day] = v
+        np.save(os.path.join(tmp_path, 'views.npy'), views)
+        with open(os.path.join(tmp_path, 'titles.json'), 'w') as fo:
+            json.dump(titles, fo)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as fo:
+            json.dump({'version': cls.VERSION, 'first_day': first_day,
+                       'n_days': n_days}, fo)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+        logger.info('Saved %d titles x %d days to: %s'
+                    % (len(titles), n_days, path))
@@ -1,63 +1,76 @@
-import cPickle
+import argparse
 import json
 import logging
+from multiprocessing import Process, cpu_count
 import os
+import shutil
+import tempfile
 
 import numpy as np
 import pandas as pd
-from sklearn.metrics import classification_report
-from sklearn.preprocessing import scale
 
-from models import Adaboost, LogisticReg, SVM
+from dataset import load_dataset
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__ if __name__ != '__main__' else [])
 
 COLUMNS = ('winner', 'Metascore', 'imdbRating', 'imdbVotes',
            'pv-release-1m', 'pv-oscar-1m', 'review_sentiment')
-DATA_CACHE = '../cache/dataset.p'
+DATA_CACHE = '../cache/dataset/'
 OUTPUT_FOLDER = '../out/imdb/unweighted/'
+N_WORKERS = cpu_count()
 
-
+# Classifiers are named by their class in `models`, which is only imported
+# and instantiated when a model is run
 CONFIG = [{'name': 'logit',
-           'clf': LogisticReg(),
+           'clf': 'LogisticReg',
            'params': {'C': [0.001, 0.01, 1, 100, 1000, 10000],
                       'class_weight': ['balanced'],
                       'n_jobs': 1,
                       'verbose': True}},
           {'name': 'svm-rbf',
-           'clf': SVM(),
+           'clf': 'SVM',
            'params': {'C': [0.001, 0.01, 1, 100, 1000, 10000],
                       'kernel': 'rbf',
                       'gamma': 'auto',
                       'class_weight': 'balanced',
                       'degree': [2, 3],
                       'verbose': True,
-                      'max_iter': -1}},
+                      'max_iter': -1,
+                      'precomputed': True}},
           {'name': 'svm-linear',
-           'clf': SVM(),
+           'clf': 'SVM',
            'params': {'C': [0.001, 0.01, 1, 100, 1000, 10000],
                       'kernel': 'linear',
                       'class_weight': 'balanced',
                       'verbose': True,
-                      'max_iter': -1}},
+                      'max_iter': -1,
+                      'precomputed': True}},
           {'name': 'svm-poly',
-           'clf': SVM(),
+           'clf': 'SVM',
            'params': {'C': [0.001, 0.01, 1, 100, 1000, 10000],
                       'kernel': 'poly',
                       'gamma': 'auto',
                       'class_weight': 'balanced',
                       'degree': [2, 3, 4],
                       'verbose': True,
-                      'max_iter': -1}},
+                      'max_iter': -1,
+                      'precomputed': True}},
           {'name': 'adaboost',
-           'clf': Adaboost(),
+           'clf': 'Adaboost',
            'params': {'max_depth': [1, 3],
                       'n_estimators': [1, 2, 4, 8, 16, 32],
-                      'learning_rate': 1.0}}]
+                      'learning_rate': 1.0,
+                      'staged': True}}]
+
+
+def make_clf(name):
+    import models
+    return getattr(models, name)()
 
 
 def run_predictions(clf, X, y, show_plot=False, **params):
+    from sklearn.metrics import classification_report
     best_params = clf.tune(X, y, **params)
     names = ['lose', 'win']
     report = classification_report(y, clf.predict(X), target_names=names)
@@ -88,26 +101,68 @@ def driver(name, clf, params, X, y):
     save_roc(roc_result, path)
 
 
-def main():
+def _run_setting(setting, data_folder, n_jobs):
+    X = pd.DataFrame(np.load(os.path.join(data_folder, 'X.npy'),
+                             mmap_mode='r'))
+    y = pd.Series(np.load(os.path.join(data_folder, 'y.npy'), mmap_mode='r'))
+    params = dict(setting['params'], n_jobs=n_jobs)
+    driver(setting['name'], make_clf(setting['clf']), params, X, y)
+
+
+def run_parallel(config, X, y, n_workers=N_WORKERS):
+    """
+    Run every setting of `config` at the same time, each in its own process
+    grid searching on its share of `n_workers` cores. X and y are saved
+    once to a temporary folder and memory-mapped by every process.
+    Processes are not daemonic, so the grid searches can start their own
+    worker processes.
+    """
+    folder = tempfile.mkdtemp(prefix='predict-')
+    procs = []
+    try:
+        np.save(os.path.join(folder, 'X.npy'), np.asarray(X))
+        np.save(os.path.join(folder, 'y.npy'), np.asarray(y))
+        for i, setting in enumerate(config):
+            n_jobs = max(1, n_workers // len(config) +
+                         (i < n_workers % len(config)))
+            logger.info('Starting %s on %d cores' % (setting['name'], n_jobs))
+            p = Process(target=_run_setting, name=setting['name'],
+                        args=(setting, folder, n_jobs))
+            p.start()
+            procs.append(p)
+        for p in procs:
+            p.join()
+    finally:
+        shutil.rmtree(folder)
+    failed = [p.name for p in procs if p.exitcode != 0]
+    if failed:
+        raise RuntimeError('Failed settings: %s' % ', '.join(failed))
+
+
+def main(n_workers=N_WORKERS):
+    from sklearn.preprocessing import scale
     if not os.path.exists(DATA_CACHE):
         logger.error('No data cached: %s' % DATA_CACHE)
 
-    with open(DATA_CACHE, 'rb') as fi:
-        data = cPickle.load(fi)
-    assert isinstance(data, pd.DataFrame)
-
-    data = data.ix[:, COLUMNS]
+    data = load_dataset(DATA_CACHE, COLUMNS)
     y = data.ix[:, 'winner']
     X = data.drop('winner', 1)
     X = scale(X)
     X = pd.DataFrame(X)
 
+    if n_workers > 1:
+        run_parallel(CONFIG, X, y, n_workers)
+        return
     for setting in CONFIG:
         name = setting['name']
-        clf = setting['clf']
+        clf = make_clf(setting['clf'])
         params = setting['params']
         driver(name, clf, params, X, y)
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--workers', type=int, default=N_WORKERS,
+                        help='number of cores, 1 runs the settings in turn')
+    args = parser.parse_args()
+    main(args.workers)
@@ -1,103 +1,100 @@
-""" Process OMDB-extracted data  """
+""" Process IMDb reviews of the OMDB-extracted movies, see preprocess.movies
+for the movie data """
 
 from __future__ import division
-from collections import defaultdict, namedtuple
+from collections import namedtuple
 from datetime import datetime
+import hashlib
+from io import BytesIO
 import json
 import logging
+from multiprocessing import Pool
 import os
 
-from bs4 import BeautifulSoup
-from bs4.element import NavigableString
+from lxml import etree, html
+import numpy as np
 import pandas as pd
-from textblob import TextBlob
 from tqdm import tqdm
 
+from preprocess.movies import Imdb
+from review_archive import ReviewArchive
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 ReviewBase = namedtuple('ReviewBase', ['id', 'title', 'date', 'votes', 'total',
                                        'text'])
 
-MOVIE_IDS = json.load(open('movie_ids.json', 'rb'))
-CEREMONIES = json.load(open('../data/ceremonies.json', 'rb'))
+MOVIE_IDS_FILE = 'movie_ids.json'
+CEREMONIES_FILE = '../data/ceremonies.json'
+# Largest number of pages parsed and scored in one batch
+BATCH_PAGES = 16
 
+# bs4, textblob and the data files are only loaded on first use, so that
+# importing this module stays cheap
+_loaded = {}
 
-class Review(ReviewBase):
-    def sentiment(self):
-        tb = TextBlob(self.text)
-        return tb.sentiment.polarity
 
+def load_json(path):
+    """ Parsed JSON file, read on first use and kept for the process """
+    if path not in _loaded:
+        with open(path, 'rb') as fi:
+            _loaded[path] = json.load(fi)
+    return _loaded[path]
 
-class Imdb(object):
-    def __init__(self, cache_folder, select=True):
-        self.cache_folder = cache_folder
-        self.select = select
 
-    def preprocess(self):
-        path = self.cache_folder + 'imdb.csv'
-        with open(path, 'rb') as fi:
-            data = pd.read_csv(fi)
+def movie_title_ids():
+    """ Map IMDb movie titles to movie ids """
+    title_to_id = {v: k for k, v in load_json(MOVIE_IDS_FILE).items()}
+    title_to_id["Precious"] = u"472"
+    return title_to_id
 
-        imdbVotes = data.ix[:, 'imdbVotes']
-        imdbVotes = imdbVotes.apply(lambda x: int(x.replace(',', '')))
-        data.ix[:, 'imdbVotes'] = imdbVotes
-        return data
 
+def get_scorer(name):
+    """ New sentiment scorer, see preprocess.sentiment.SCORERS """
+    from preprocess.sentiment import SCORERS
+    return SCORERS[name]()
 
-class ImdbReviews(object):
 
-    title_to_id = {v: k for k, v in MOVIE_IDS.items()}
-    title_to_id["Precious"] = u"472"
+# Review fields as they appear on a page: title, date text, helpful votes,
+# total votes and body
+RawReview = namedtuple('RawReview', ['title', 'date', 'votes', 'total',
+                                     'body'])
 
-    def __init__(self, cache_folder, imdb_df):
-        self.cache_folder = cache_folder
-        self.imdb_df = imdb_df
+HTML_PARSER = html.HTMLParser(encoding='utf-8')
+XPATHS = {'movie': etree.XPath('(//*[@id="tn15title"])[1]'
+                               '/descendant::h1[1]/descendant::a[1]'),
+          'reviews': etree.XPath('(//*[@id="tn15content"])[1]'
+                                 '/div[descendant::small]'),
+          'title': etree.XPath('string(descendant::h2[1])',
+                               smart_strings=False),
+          'text': etree.XPath('string()', smart_strings=False),
+          'small': etree.XPath('descendant::small'),
+          # Third element after the first <small> in document order, as
+          # found by BeautifulSoup's find_next().find_next().find_next()
+          'rating': etree.XPath('(descendant::* | following::*)[3]')}
 
-    def preprocess(self, weighted=True):
-        data = defaultdict(lambda: defaultdict(list))
-        feats = defaultdict(list)
-        for root, dirs, fns in os.walk(self.cache_folder):
-            logger.info('Processing: %s' % root)
-            for fn in tqdm(fns):
-                if os.path.splitext(fn)[1] != '.html':
-                    continue
-                for id, r in self.get_reviews(os.path.join(root, fn)):
-                    data[id]['sentiment'].append(r.sentiment())
-                    data[id]['support'].append(r.votes + 1)
-                    data[id]['total'].append(r.total + 1)
-        for id, d in data.items():
-            feats['id'].append(int(id))
-            if weighted:
-                numerator = 0
-                denominator = sum(d['total'])
-                logger.info('movie id: %s  sums: (%d, %d): '
-                            % (id, sum(d['support']), denominator))
-                for support, sentiment in zip(d['support'], d['sentiment']):
-                    numerator += support * sentiment
-                score = numerator / denominator
-            else:
-                score = sum(d['sentiment']) / len(d['sentiment'])
-            feats['review_sentiment'].append(score)
-        feats = pd.DataFrame(feats)
-        return feats
-
-    def get_reviews(self, path):
-        logger.debug('Parsing: %s' % path)
-        soup = BeautifulSoup(open(path, 'rb'), 'lxml')
-        movie = soup.find(id='tn15title').h1.a.text
-        id = self.title_to_id[movie]
-        tn15 = soup.find(id='tn15content')
 
-        release_date = self.imdb_df[self.imdb_df['id'] == int(id)]['Released']
-        release_date = release_date.values[0]
-        release_date = datetime.strptime(release_date, "%d %b %Y").date()
-        yr = release_date.year
-        if yr == 2016:
-            yr = 2015
-        cer_date = CEREMONIES[str(yr)]
-        cer_date = datetime.strptime(cer_date, "%d-%b-%y").date()
+def read_markup(page):
+    """ Bytes of a saved page, given as a path or a file object """
+    if hasattr(page, 'read'):
+        return page.read()
+    with open(page, 'rb') as fi:
+        return fi.read()
+
+
+def extract_reviews_soup(page):
+    """
+    Movie title and RawReviews of a saved review page, given as a path or
+    a file object
+    """
+    from bs4 import BeautifulSoup
+    from bs4.element import NavigableString
+    soup = BeautifulSoup(read_markup(page), 'lxml')
+    movie = soup.find(id='tn15title').h1.a.text
+    tn15 = soup.find(id='tn15content')
 
+    def reviews():
         for c in tn15.children:
             if isinstance(c, NavigableString):
                 continue
@@ -111,9 +108,477 @@ class ImdbReviews(object):
                 else:
                     votes, total = 0, 0
                 date = small_tags[-1].text
-                date = datetime.strptime(date, '%d %B %Y').date()
-                if date >= cer_date:
-                    continue
                 body = c.next_sibling.next_sibling.text
-                r = Review(id, title, date, votes, total, body)
+                yield RawReview(title, date, votes, total, body)
+    return movie, reviews()
+
+
+def extract_reviews_lxml(page):
+    """
+    Same as `extract_reviews_soup`, but evaluates compiled XPaths for only
+    the fields used instead of building a BeautifulSoup tree.
+    """
+    from bs4 import UnicodeDammit
+    # Decode like BeautifulSoup does, then hand lxml UTF-8
+    markup = UnicodeDammit(read_markup(page), is_html=True).unicode_markup
+    doc = html.document_fromstring(markup.encode('utf-8'), HTML_PARSER)
+    text = XPATHS['text']
+    movie = text(XPATHS['movie'](doc)[0])
+
+    def reviews():
+        for c in XPATHS['reviews'](doc):
+            small_tags = XPATHS['small'](c)
+            rating = XPATHS['rating'](small_tags[0])
+            if rating and rating[0].tag == 'img':
+                header = text(small_tags[0]).split()
+                votes, total = int(header[0]), int(header[3])
+            else:
+                votes, total = 0, 0
+            # c.next_sibling.next_sibling: skip the whitespace after the div
+            body = c.getnext() if c.tail else c.getnext().getnext()
+            yield RawReview(XPATHS['title'](c), text(small_tags[-1]), votes,
+                            total, text(body))
+    return movie, reviews()
+
+
+EXTRACTORS = {'soup': extract_reviews_soup,
+              'lxml': extract_reviews_lxml}
+
+
+_review_dates = {}
+
+
+def parse_review_date(s):
+    """ Date of a review date text, e.g. '3 March 2013', memoized """
+    try:
+        return _review_dates[s]
+    except KeyError:
+        d = _review_dates[s] = datetime.strptime(s, '%d %B %Y').date()
+        return d
+
+
+def ceremony_cutoffs(imdb_df):
+    """
+    Map movie ids to the date of the ceremony honoring the films of their
+    release year, e.g. February 2013 for a 2012 release (the 2015 ceremony
+    for 2016 releases). Reviews from that day on are left out. Movies
+    without a release date or ceremony have no cutoff, and all their
+    reviews are kept.
+    """
+    ceremonies = dict((int(yr), datetime.strptime(d, "%d-%b-%y").date())
+                      for yr, d in load_json(CEREMONIES_FILE).items())
+    cutoffs = {}
+    for id, released in zip(imdb_df['id'], imdb_df['Released']):
+        try:
+            yr = datetime.strptime(released, "%d %b %Y").year
+        except (TypeError, ValueError):
+            logger.debug('No release date for movie id: %s' % id)
+            continue
+        if yr == 2016:
+            yr = 2015
+        if yr in ceremonies:
+            cutoffs[int(id)] = ceremonies[yr]
+    return cutoffs
+
+
+class Review(ReviewBase):
+    def sentiment(self):
+        from textblob import TextBlob
+        tb = TextBlob(self.text)
+        return tb.sentiment.polarity
+
+
+class ReviewTable(object):
+    """
+    All reviews of the saved pages as columns, before the ceremony cutoff
+    is applied, so features can be aggregated without parsing pages.
+
+    A table is one .npz file with the columns:
+
+        id         movie id
+        date       review date ordinal
+        votes      helpful votes
+        total      total votes
+        sentiment  review polarity
+        offset     start of the UTF-8 review text in `texts`
+        length     length of the UTF-8 review text
+
+    and the format version, the sentiment scorer version, the `pages_key`
+    of the pages the table was built from, see ImdbReviews.pages_key, and
+    optionally a `source` string identifying the pages, e.g. their content
+    hash. `load` reads the columns, and `texts` is only read from the file
+    on first use, so aggregating does not decompress the texts.
+    """
+
+    VERSION = 2
+    COLUMNS = ('id', 'date', 'votes', 'total', 'sentiment', 'offset',
+               'length')
+
+    def __init__(self, columns, texts, scorer, source=None, pages_key=None,
+                 path=None):
+        """
+        Parameters
+        ----------
+        columns : dict of COLUMNS arrays
+        texts : uint8 array of the UTF-8 review texts, or None to read them
+                from `path` on first use
+        scorer : version of the sentiment scorer
+        source : identifies the pages
+        pages_key : see ImdbReviews.pages_key
+        path : .npz file the table was loaded from
+        """
+        self.columns = columns
+        self._texts = texts
+        self.scorer = scorer
+        self.source = source
+        self.pages_key = pages_key
+        self.path = path
+
+    @property
+    def texts(self):
+        if self._texts is None:
+            with np.load(self.path) as npz:
+                self._texts = npz['texts']
+        return self._texts
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def text(self, i):
+        start = self['offset'][i]
+        end = start + self['length'][i]
+        return self.texts[start:end].tostring().decode('utf-8')
+
+    @classmethod
+    def from_records(cls, records, scorer, source=None, pages_key=None):
+        """
+        Build a table from (id, date ordinal, votes, total, text, sentiment)
+        records and the version of the scorer of their sentiment
+        """
+        n = len(records)
+        columns = dict((c, np.zeros(n, dtype=np.int32))
+                       for c in ('id', 'date', 'votes', 'total'))
+        columns['sentiment'] = np.zeros(n)
+        columns['offset'] = np.zeros(n, dtype=np.int64)
+        columns['length'] = np.zeros(n, dtype=np.int64)
+        texts = []
+        offset = 0
+        for i, (id, date, votes, total, text, sentiment) in \
+                enumerate(records):
+            text = text.encode('utf-8')
+            columns['id'][i] = int(id)
+            columns['date'][i] = date
+            columns['votes'][i] = votes
+            columns['total'][i] = total
+            columns['sentiment'][i] = sentiment
+            columns['offset'][i] = offset
+            columns['length'][i] = len(text)
+            texts.append(text)
+            offset += len(text)
+        texts = np.frombuffer(b''.join(texts), dtype=np.uint8)
+        return cls(columns, texts, scorer, source, pages_key)
+
+    @classmethod
+    def load(cls, path):
+        """ Table saved at `path`, with its texts left in the file """
+        with np.load(path) as npz:
+            if int(npz['version']) != cls.VERSION:
+                raise ValueError('Unsupported review table version %s in: %s'
+                                 % (npz['version'], path))
+            columns = dict((c, npz[c]) for c in cls.COLUMNS)
+            source = str(npz['source']) if 'source' in npz.files else None
+            return cls(columns, None, str(npz['scorer']), source,
+                       str(npz['pages_key']), path)
+
+    def save(self, path):
+        """ Write to a temporary file, then rename it into place """
+        tmp_path = path + '.tmp'
+        arrays = dict(self.columns, texts=self.texts,
+                      version=np.array(self.VERSION),
+                      scorer=np.array(self.scorer),
+                      pages_key=np.array(self.pages_key))
+        if self.source is not None:
+            arrays['source'] = np.array(self.source)
+        with open(tmp_path, 'wb') as fo:
+            np.savez_compressed(fo, **arrays)
+        os.rename(tmp_path, path)
+        logger.info('Saved %d reviews to: %s' % (len(self), path))
+
+
+_worker = {}
+
+
+def _init_review_worker(reviews):
+    _worker['reviews'] = reviews
+
+
+def _score_pages(pages):
+    return _worker['reviews'].score_pages(pages)
+
+
+class ImdbReviews(object):
+
+    def __init__(self, cache_folder, imdb_df, parser='lxml',
+                 sentiment_cache=None, table_path=None):
+        """
+        Parameters
+        ----------
+        cache_folder : folder of saved review pages, or a ReviewArchive file
+        imdb_df : preprocessed Imdb data
+        parser : page extractor, 'lxml' or 'soup', see EXTRACTORS
+        sentiment_cache : SentimentCache to reuse scores of unchanged reviews
+        table_path : .npz file to save the parsed reviews to and load them
+                     from, see ReviewTable
+        """
+        self.cache_folder = cache_folder
+        self.archive = None
+        if ReviewArchive.is_archive(cache_folder):
+            self.archive = ReviewArchive(cache_folder)
+        self.imdb_df = imdb_df
+        self.parser = parser
+        self.sentiment_cache = sentiment_cache
+        self.table_path = table_path
+        self.scorer = None
+        self.title_to_id = movie_title_ids()
+        self.cutoffs = ceremony_cutoffs(imdb_df)
+
+    def page_paths(self):
+        paths = []
+        for root, dirs, fns in os.walk(self.cache_folder):
+            logger.info('Found: %s' % root)
+            for fn in fns:
+                if os.path.splitext(fn)[1] == '.html':
+                    paths.append(os.path.join(root, fn))
+        return paths
+
+    def pages(self):
+        """
+        All saved pages, as paths in a folder or (title, page number) in a
+        ReviewArchive
+        """
+        if self.archive is not None:
+            return list(self.archive)
+        return self.page_paths()
+
+    def open_page(self, page):
+        """ Path or file object of a page from `pages` """
+        if self.archive is not None:
+            return BytesIO(self.archive.read(*page))
+        return page
+
+    def page_movie(self, page):
+        """ Movie folder or title of a page from `pages` """
+        if self.archive is not None:
+            return page[0]
+        return os.path.dirname(page)
+
+    def pages_key(self, pages):
+        """
+        Hash of the pages, by path, size and modification time in a folder
+        or by index entry in a ReviewArchive, which decide the contents of
+        a ReviewTable
+        """
+        h = hashlib.sha1()
+        for p in pages:
+            if self.archive is not None:
+                title, number = p
+                offset, length = self.archive.index[title][number]
+                stamp = [title, number, offset, length]
+            else:
+                st = os.stat(p)
+                stamp = [p, st.st_size, st.st_mtime]
+            h.update(json.dumps(stamp))
+        return h.hexdigest()
+
+    def score_pages(self, pages):
+        """
+        (id, date ordinal, votes, total, text, sentiment) of every review on
+        the pages, and a dict of the scores missing from the sentiment
+        cache. Reviews missing from the cache are scored in one batch.
+        """
+        if self.scorer is None:
+            self.scorer = get_scorer('textblob')
+        cache = self.sentiment_cache
+        reviews = [r for page in pages for r in self.read_page(page)[1]]
+        scores = [None] * len(reviews)
+        keys = [None] * len(reviews)
+        if cache is not None:
+            for i, r in enumerate(reviews):
+                keys[i] = cache.key(r.text)
+                scores[i] = cache.get(keys[i])
+        todo = [i for i, s in enumerate(scores) if s is None]
+        new_scores = {}
+        if todo:
+            texts = [reviews[i].text for i in todo]
+            for i, s in zip(todo, self.scorer.score_many(texts)):
+                scores[i] = float(s)
+                if cache is not None:
+                    new_scores[keys[i]] = scores[i]
+        records = [(r.id, r.date.toordinal(), r.votes, r.total, r.text, s)
+                   for r, s in zip(reviews, scores)]
+        return records, new_scores
+
+    def batches(self, pages, size=BATCH_PAGES):
+        """
+        Split pages into batches of up to `size` pages of one movie, keeping
+        their order, so a movie with many pages is spread over the workers
+        """
+        batches = []
+        for p in pages:
+            movie = self.page_movie(p)
+            if (batches and len(batches[-1]) < size and
+                    self.page_movie(batches[-1][0]) == movie):
+                batches[-1].append(p)
+            else:
+                batches.append([p])
+        return batches
+
+    def build_table(self, n_workers=1, scorer='textblob', source=None,
+                    pages=None):
+        """
+        Parse and score all saved pages into a ReviewTable
+
+        Parameters
+        ----------
+        n_workers : number of processes parsing and scoring pages. Pages
+                    are combined in walk order, so results do not depend on
+                    the number of workers.
+        scorer : sentiment scorer, 'textblob' or 'lexicon', see SCORERS.
+                 The reviews of each batch of pages are scored together,
+                 see `batches`.
+        source : identifies the pages in the table, see ReviewTable
+        pages : the saved pages, if already listed by `pages`
+        """
+        self.scorer = get_scorer(scorer)
+        if (self.sentiment_cache is not None and
+                self.sentiment_cache.model != self.scorer.version):
+            raise ValueError('Sentiment cache of model %s cannot hold %s '
+                             'scores' % (self.sentiment_cache.model,
+                                         self.scorer.version))
+        paths = self.pages() if pages is None else pages
+        batches = self.batches(paths)
+        logger.info('Processing %d pages in %d batches..'
+                    % (len(paths), len(batches)))
+        pool = None
+        if n_workers > 1:
+            pool = Pool(n_workers, _init_review_worker, (self,))
+            pages = pool.imap(_score_pages, batches)
+        else:
+            pages = (self.score_pages(b) for b in batches)
+        records = []
+        n_scored = 0
+        try:
+            for page_records, new_scores in tqdm(pages, total=len(batches)):
+                records.extend(page_records)
+                if new_scores:
+                    self.sentiment_cache.put_many(new_scores)
+                    n_scored += len(new_scores)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        if self.sentiment_cache is not None:
+            logger.info('Scored %d new reviews, cache: %s'
+                        % (n_scored, self.sentiment_cache.path))
+        return ReviewTable.from_records(records, self.scorer.version, source,
+                                        self.pages_key(paths))
+
+    def review_table(self, n_workers=1, scorer='textblob', rebuild=False,
+                     source=None):
+        """
+        The ReviewTable saved at `table_path`, or a newly built one if there
+        is none, it was scored by another scorer, it has another `source`,
+        pages were added or changed since it was built (see `pages_key`) or
+        `rebuild` is set.
+        """
+        from preprocess.sentiment import SCORERS
+        version = SCORERS[scorer].version
+        path = self.table_path
+        pages = self.pages()
+        if path is not None and os.path.exists(path) and not rebuild:
+            try:
+                table = ReviewTable.load(path)
+            except (ValueError, KeyError) as e:
+                logger.info('Rebuilding %s: %s' % (path, e))
+            else:
+                if (table.scorer == version and table.source == source and
+                        table.pages_key == self.pages_key(pages)):
+                    logger.info('Loaded %d reviews from: %s'
+                                % (len(table), path))
+                    return table
+                logger.info('Rebuilding %s of %s scored by %s, or of '
+                            'changed pages' % (path, table.source,
+                                               table.scorer))
+        table = self.build_table(n_workers, scorer, source, pages)
+        if path is not None:
+            table.save(path)
+        return table
+
+    def aggregate(self, table, weighted=True):
+        """
+        Review sentiment per movie from the reviews of a ReviewTable written
+        before the movie's ceremony
+
+        Parameters
+        ----------
+        table : ReviewTable
+        weighted : weight review sentiment by helpful votes
+        """
+        movies, movie = np.unique(table['id'], return_inverse=True)
+        # Movies without a cutoff keep all their reviews
+        no_cutoff = np.iinfo(np.int64).max
+        cutoffs = np.array([self.cutoffs[id].toordinal()
+                            if id in self.cutoffs else no_cutoff
+                            for id in movies], dtype=np.int64)
+        keep = table['date'] < cutoffs[movie]
+        movie = movie[keep]
+        sentiment = table['sentiment'][keep]
+        n = len(movies)
+        if weighted:
+            # Votes + 1, so reviews without votes still count
+            support = table['votes'][keep] + 1.0
+            numerator = np.bincount(movie, support * sentiment, minlength=n)
+            denominator = np.bincount(movie, table['total'][keep] + 1.0,
+                                      minlength=n)
+        else:
+            numerator = np.bincount(movie, sentiment, minlength=n)
+            denominator = np.bincount(movie, minlength=n)
+        found = denominator > 0
+        return pd.DataFrame({'id': movies[found].astype(int),
+                             'review_sentiment': (numerator[found] /
+                                                  denominator[found])})
+
+    def preprocess(self, weighted=True, n_workers=1, scorer='textblob',
+                   rebuild=False, source=None):
+        """
+        Parameters
+        ----------
+        weighted : weight review sentiment by helpful votes
+        n_workers : number of processes parsing and scoring pages
+        scorer : sentiment scorer, 'textblob' or 'lexicon', see SCORERS
+        rebuild : parse the pages again even if a review table is saved
+        source : identifies the pages, a saved review table of other pages
+                 is rebuilt
+        """
+        table = self.review_table(n_workers, scorer, rebuild, source)
+        return self.aggregate(table, weighted)
+
+    def read_page(self, page):
+        """ Movie id and all Reviews of a page from `pages` """
+        logger.debug('Parsing: %s' % (page,))
+        extract = EXTRACTORS[self.parser]
+        movie, reviews = extract(self.open_page(page))
+        id = self.title_to_id[movie]
+        return id, [Review(id, title, parse_review_date(date), votes, total,
+                           body)
+                    for title, date, votes, total, body in reviews]
+
+    def get_reviews(self, page):
+        id, reviews = self.read_page(page)
+        cer_date = self.cutoffs.get(int(id))
+        for r in reviews:
+            if cer_date is None or r.date < cer_date:
                 yield id, r
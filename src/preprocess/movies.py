@@ -0,0 +1,27 @@
+""" Process OMDB-extracted movie data.
+
+Kept apart from the review code in preprocess.imdb, so the movie table
+stage of run_preprocess only depends on the code that builds it.
+"""
+
+import logging
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+class Imdb(object):
+    def __init__(self, cache_folder, select=True):
+        self.cache_folder = cache_folder
+        self.select = select
+
+    def preprocess(self):
+        path = self.cache_folder + 'imdb.csv'
+        with open(path, 'rb') as fi:
+            data = pd.read_csv(fi)
+
+        imdbVotes = data.ix[:, 'imdbVotes']
+        imdbVotes = imdbVotes.apply(lambda x: int(x.replace(',', '')))
+        data.ix[:, 'imdbVotes'] = imdbVotes
+        return data
@@ -1,24 +1,166 @@
 """ Feature extraction for pageview data """
 
+from collections import defaultdict, namedtuple
 from datetime import datetime, timedelta
+from glob import glob
 import json
 import logging
+import os
 
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
+
+from pagecounts import ViewsMatrix, parse_day
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 CEREMONIES = '../data/ceremonies.json'
+NOMINATIONS = '../data/nominations.json'
 WIKI_TITLES = "../src/wiki_titles.json"
+COUNT_COLUMNS = ['date', 'title', 'views']
+ANCHORS = ('release', 'nomination', 'ceremony')
+
+# Feature specs. Windows cover days [anchor + start, anchor + end), where
+# anchor is one of ANCHORS.
+#   Window: total views in the window
+#   Peak:   highest views on a single day in the window
+#   Growth: (views in window + 1) / (views in base + 1), both Windows
+Window = namedtuple('Window', ['name', 'anchor', 'start', 'end'])
+Peak = namedtuple('Peak', ['name', 'anchor', 'start', 'end'])
+Growth = namedtuple('Growth', ['name', 'window', 'base'])
+
+# The original features: views strictly between the day 30 days before
+# release and release, and strictly between the ceremony and 30 days after
+DEFAULT_SPEC = [Window('pv-release-1m', 'release', -29, 0),
+                Window('pv-oscar-1m', 'ceremony', 1, 30)]
+
+
+def window_spec(lengths=(7, 14, 30, 60, 90), anchors=ANCHORS):
+    """
+    Features for every anchor and window length, e.g. for 'ceremony' and 30:
+
+        pv-ceremony-pre-30d     views in the 30 days before the ceremony
+        pv-ceremony-post-30d    views in the 30 days after the ceremony
+        pv-ceremony-growth-30d  post / pre growth ratio
+        pv-ceremony-peak-30d    peak day in the 30 days after the ceremony
+    """
+    spec = []
+    for anchor in anchors:
+        for n in lengths:
+            name = 'pv-%s-%%s-%dd' % (anchor, n)
+            pre = Window(name % 'pre', anchor, -n, 0)
+            post = Window(name % 'post', anchor, 1, n + 1)
+            spec.extend([pre, post, Growth(name % 'growth', post, pre),
+                         Peak(name % 'peak', anchor, 1, n + 1)])
+    return spec
+
+
+def read_counts(path):
+    """
+    Read views per day from a viewsperday.csv file, or from a folder of
+    headerless part files written by reduce_pageviews.count_raws.
+    ViewsMatrix stores are opened by PageViews directly.
+    """
+    if not os.path.isdir(path):
+        return pd.read_csv(open(path, 'rb'))
+    parts = [p for p in sorted(glob(os.path.join(path, 'part-*')))
+             if os.path.getsize(p) > 0]
+    frames = [pd.read_csv(open(p, 'rb'), header=None, names=COUNT_COLUMNS)
+              for p in parts]
+    if not frames:
+        return pd.DataFrame(columns=COUNT_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+
+class CumulativeViews(object):
+    """
+    Running totals of views per movie id over consecutive days.
+
+    The views of a movie on days [start, end) are cum[row, end - first_day]
+    minus cum[row, start - first_day], so every window sum costs two array
+    lookups regardless of its length.
+    """
+
+    def __init__(self, ids, first_day, views):
+        self.first_day = first_day
+        self.n_days = views.shape[1]
+        self.row = dict((id, i) for i, id in enumerate(ids))
+        self.views = views
+        self.cum = np.zeros((len(ids), self.n_days + 1), dtype=np.int64)
+        np.cumsum(views, axis=1, out=self.cum[:, 1:])
+
+    @classmethod
+    def from_frame(cls, data):
+        """ Build from a frame with date (YYYYMMDD), id and views columns """
+        if not len(data):
+            return cls([], 0, np.zeros((0, 0), dtype=np.int64))
+        # Parse each distinct day once
+        ordinals = dict((d, parse_day(d)) for d in data['date'].unique())
+        days = data['date'].map(ordinals).values
+        ids, rows = np.unique(data['id'].values.astype(np.int64),
+                              return_inverse=True)
+        first_day = days.min()
+        views = np.zeros((len(ids), days.max() - first_day + 1),
+                         dtype=np.int64)
+        np.add.at(views, (rows, days - first_day), data['views'].values)
+        return cls(ids, first_day, views)
+
+    @classmethod
+    def from_matrix(cls, matrix, rows_by_id):
+        """ Build from the ViewsMatrix rows of each movie id """
+        ids = sorted(rows_by_id)
+        views = np.zeros((len(ids), matrix.n_days), dtype=np.int64)
+        for i, id in enumerate(ids):
+            views[i] = matrix.views[rows_by_id[id]].sum(axis=0)
+        return cls(ids, matrix.first_day, views)
+
+    def rows(self, ids):
+        """ Rows of `ids`, -1 for ids without views """
+        return np.array([self.row.get(id, -1) for id in ids], dtype=np.int64)
+
+    def _columns(self, start, end):
+        a = np.clip(np.asarray(start) - self.first_day, 0, self.n_days)
+        b = np.clip(np.asarray(end) - self.first_day, 0, self.n_days)
+        return a, np.maximum(a, b)
+
+    def window(self, ids, start, end, rows=None):
+        """
+        Views of each movie in `ids` on days [start, end), where start and
+        end are arrays of date ordinals. Unknown ids have no views.
+        """
+        if rows is None:
+            rows = self.rows(ids)
+        a, b = self._columns(start, end)
+        sums = np.zeros(len(rows), dtype=np.int64)
+        known = rows >= 0
+        sums[known] = (self.cum[rows[known], b[known]] -
+                       self.cum[rows[known], a[known]])
+        return sums
+
+    def peak(self, ids, start, end, rows=None):
+        """ Highest views on a single day in [start, end) for each movie """
+        if rows is None:
+            rows = self.rows(ids)
+        a, b = self._columns(start, end)
+        peaks = np.zeros(len(rows), dtype=np.int64)
+        known = rows >= 0
+        width = int((b - a)[known].max()) if known.any() else 0
+        if width == 0:
+            return peaks
+        cols = a[known][:, None] + np.arange(width)[None, :]
+        inside = cols < b[known][:, None]
+        cols = np.minimum(cols, self.n_days - 1)
+        days = self.views[rows[known][:, None], cols]
+        peaks[known] = np.where(inside, days, 0).max(axis=1)
+        return peaks
 
 
 class PageViews(object):
     def __init__(self, file_path, imdb_df):
         self.imdb_df = imdb_df
         self.cer = json.load(open(CEREMONIES, 'rb'))
+        self.nom = json.load(open(NOMINATIONS, 'rb'))
 
         wt = json.load(open(WIKI_TITLES, 'rb'))
         title_to_id = {v: k for k, v in wt.items()}
@@ -27,13 +169,54 @@ class PageViews(object):
         title_to_id[u"Winter's_Bone"] = u"485"
 
         logger.info('Loading: %s' % file_path)
-        data = pd.read_csv(open(file_path, 'rb'))
+        self.matrix = None
+        self._cumulative = None
+        if ViewsMatrix.is_store(file_path):
+            self._load_matrix(file_path, title_to_id)
+            return
+        data = read_counts(file_path)
+        data['id'] = self.resolve_ids(data['title'], title_to_id)
+        self.data = data[data['id'] >= 0]
 
-        ids = pd.Series(np.zeros(len(data)), index=data.index)
-        for idx, row in tqdm(data.iterrows(), total=len(data)):
-            ids[idx] = int(title_to_id[row['title']])
-        data['id'] = ids
-        self.data = data
+    @staticmethod
+    def resolve_ids(titles, title_to_id):
+        """
+        Map a column of titles to movie ids, -1 for unknown titles. Each
+        distinct title is looked up once and the ids are gathered by code.
+        """
+        codes, uniques = pd.factorize(titles)
+        lookup = np.array([int(title_to_id.get(t, -1)) for t in uniques] +
+                          [-1], dtype=np.int64)
+        # Missing values have code -1, which picks the trailing -1
+        ids = lookup[codes]
+        unknown = [t for t in uniques if t not in title_to_id]
+        if unknown:
+            logger.warning('Dropping %d rows of %d unknown titles: %s'
+                           % ((ids < 0).sum(), len(unknown),
+                              ', '.join(repr(t) for t in sorted(unknown))))
+        return ids
+
+    def _load_matrix(self, path, title_to_id):
+        # Store titles are unicode, e.g. the latin-1 encoded key above is
+        # u'Les_Mis\xc3\xa9rables_(2012_film)' in the store
+        title_to_id = dict((t.decode('latin-1') if isinstance(t, bytes)
+                            else t, int(i))
+                           for t, i in title_to_id.items())
+        self.matrix = ViewsMatrix(path)
+        self.data = None
+        self.rows = defaultdict(list)
+        for row, title in enumerate(self.matrix.titles):
+            if title in title_to_id:
+                self.rows[title_to_id[title]].append(row)
+
+    def _matrix_window(self, id, start, end):
+        """ Views of movie `id` on the days strictly between start and end """
+        rows = self.rows.get(id)
+        a = max(self.matrix.column(start) + 1, 0)
+        b = min(self.matrix.column(end), self.matrix.n_days)
+        if not rows or a >= b:
+            return 0
+        return int(self.matrix.views[rows, a:b].sum())
 
     @staticmethod
     def convert_dates(x):
@@ -47,32 +230,65 @@ class PageViews(object):
             d = str(int(d) - 1)
             return PageViews.convert_dates(y + m + d)
 
-    def _extract_feats(self, id, release_date):
-        df = self.data[self.data['id'] == id]
-        dates = df['date']
-        dates = dates.apply(self.convert_dates)
-        df['date'] = dates
+    def _anchors(self, release_date):
+        """ ANCHORS dates of a movie released on `release_date` """
         release_date = datetime.strptime(release_date, "%d %b %Y").date()
+        yr = release_date.year
+        if yr == 2016:
+            yr = 2015
+        cer_date = datetime.strptime(self.cer[str(yr)], "%d-%b-%y").date()
+        nom_date = datetime.strptime(self.nom[str(yr)], "%d-%b-%y").date()
+        return {'release': release_date, 'nomination': nom_date,
+                'ceremony': cer_date}
+
+    def cumulative(self):
+        if self._cumulative is None:
+            if self.matrix is not None:
+                self._cumulative = CumulativeViews.from_matrix(self.matrix,
+                                                               self.rows)
+            else:
+                self._cumulative = CumulativeViews.from_frame(self.data)
+        return self._cumulative
+
+    def _extract_feats(self, id, release_date):
+        if self.matrix is not None:
+            window = lambda start, end: self._matrix_window(id, start, end)
+        else:
+            df = self.data[self.data['id'] == id]
+            dates = df['date']
+            dates = dates.apply(self.convert_dates)
+            df['date'] = dates
+
+            def window(start, end):
+                matching = df[(df['date'] > start) & (df['date'] < end)]
+                return sum(matching['views'])
+        anchors = self._anchors(release_date)
+        release_date, cer_date = anchors['release'], anchors['ceremony']
 
         start = release_date - timedelta(days=30)
         end = release_date
-        matching = df[(df['date'] > start) & (df['date'] < end)]
-        pv_release_1m = sum(matching['views'])
+        pv_release_1m = window(start, end)
 
-        yr = release_date.year
-        if yr == 2016:
-            yr = 2015
-        start = self.cer[str(yr)]
-        start = datetime.strptime(start, "%d-%b-%y").date()
+        start = cer_date
         end = start + timedelta(days=30)
-        matching = df[(df['date'] > start) & (df['date'] < end)]
-        pv_oscar_1m = sum(matching['views'])
+        pv_oscar_1m = window(start, end)
 
         f = {'id': id, 'pv-release-1m': pv_release_1m,
              'pv-oscar-1m': pv_oscar_1m}
         return f
 
-    def preprocess(self):
+    def preprocess(self, vectorized=True, spec=None):
+        """
+        Parameters
+        ----------
+        vectorized : compute all features in one batched pass
+        spec : list of Window, Peak and Growth features, DEFAULT_SPEC if
+               None. Only the default features are available unvectorized.
+        """
+        if vectorized:
+            return self.compute_features(spec or DEFAULT_SPEC)
+        if spec is not None and spec != DEFAULT_SPEC:
+            raise ValueError('Feature specs require vectorized=True')
         feats = {'id': [], 'pv-release-1m': [], 'pv-oscar-1m': []}
         for idx, row in self.imdb_df.iterrows():
             id = row['id']
@@ -82,3 +298,36 @@ class PageViews(object):
                 feats[k].append(v)
         feats = pd.DataFrame(feats)
         return feats
+
+    def compute_features(self, spec):
+        """ Compute every feature in `spec` for all movies in one pass """
+        ids = self.imdb_df['id'].values
+        dates = [self._anchors(x) for x in self.imdb_df['Released']]
+        anchors = dict((a, np.array([d[a].toordinal() for d in dates]))
+                       for a in ANCHORS)
+        cum = self.cumulative()
+        rows = cum.rows(ids)
+        sums = {}
+
+        def window(w):
+            key = (w.anchor, w.start, w.end)
+            if key not in sums:
+                day = anchors[w.anchor]
+                sums[key] = cum.window(ids, day + w.start, day + w.end, rows)
+            return sums[key]
+
+        feats = {'id': ids}
+        for f in spec:
+            if isinstance(f, Window):
+                feats[f.name] = window(f)
+            elif isinstance(f, Peak):
+                day = anchors[f.anchor]
+                feats[f.name] = cum.peak(ids, day + f.start, day + f.end,
+                                         rows)
+            elif isinstance(f, Growth):
+                feats[f.name] = ((window(f.window) + 1) /
+                                 (window(f.base) + 1).astype(np.float64))
+            else:
+                raise ValueError('Unknown feature spec: %r' % (f,))
+        feats = pd.DataFrame(feats)
+        return feats
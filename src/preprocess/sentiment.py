@@ -0,0 +1,248 @@
+""" Review sentiment scorers and cached scores """
+
+from __future__ import division
+from collections import defaultdict
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+from xml.etree import cElementTree
+
+import numpy as np
+import textblob
+from textblob import TextBlob
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TEXTBLOB_MODEL = 'textblob-%s-pattern' % textblob.__version__
+LEXICON = os.path.join(os.path.dirname(textblob.__file__), 'en',
+                       'en-sentiment.xml')
+# pattern's negations and modifier tags. TextBlob splits apostrophes off
+# unicode text, so "n't" never reaches the analyzer and is left out.
+NEGATIONS = (u'no', u'not', u'never')
+MODIFIERS = ('RB',)
+# Words with inner hyphens or dots ("well-made", "e.g"), "..." and single
+# punctuation marks, close to pattern's tokenizer
+TOKEN = re.compile(r"[^\W_]+(?:[-.][^\W_]+)*|\.\.\.|[^\w\s]", re.UNICODE)
+
+
+class TextBlobScorer(object):
+    """ TextBlob's pattern analyzer, one review at a time """
+
+    version = TEXTBLOB_MODEL
+
+    def score_many(self, texts):
+        return np.array([TextBlob(t).sentiment.polarity for t in texts])
+
+
+class LexiconScorer(object):
+    """
+    Batched approximation of TextBlob's pattern analyzer.
+
+    The pattern lexicon is compiled once into NumPy arrays indexed by word
+    id. A batch of texts is tokenized once, its distinct tokens are mapped
+    to word ids, and the rules of pattern's `Sentiment.assessments` are
+    applied with array operations over all tokens of the batch:
+
+    - every lexicon word is an assessment, and a review's polarity is the
+      mean polarity of its assessments
+    - a lexicon word right after a modifier ("very good", "very, good")
+      joins the modifier's assessment, with its polarity scaled by the
+      modifier's intensity
+    - a negation before a word, also across short tokens ("not a good"),
+      or right after an "-ly" modifier ("really not good") turns the assessment's
+      polarity into -0.5 times the polarity
+    - each "!" scales the polarity of the assessment before it by 1.25
+
+    Emoticons and sarcasm marks "(!)" are not scored, so scores are close
+    to TextBlob's but not identical; see bench_sentiment.py.
+    """
+
+    version = 'lexicon-1'
+
+    def __init__(self, path=LEXICON):
+        senses = defaultdict(lambda: defaultdict(list))
+        xml = cElementTree.parse(path).getroot()
+        for w in xml.findall('word'):
+            form = w.attrib.get('form')
+            if form:
+                senses[form][w.attrib.get('pos')].append(
+                    (float(w.attrib.get('polarity', 0.0)),
+                     float(w.attrib.get('intensity', 1.0))))
+        # Average the senses of each part of speech, then the parts of
+        # speech, as pattern does
+        lexicon = {}
+        for w, by_pos in senses.items():
+            lexicon[w] = dict((pos, np.mean(v, axis=0))
+                              for pos, v in by_pos.items())
+            lexicon[w][None] = np.mean(list(lexicon[w].values()), axis=0)
+        # Adverbs of adjectives, "terrible" => "terribly", as TextBlob adds
+        for w in sorted(lexicon):
+            if 'JJ' in lexicon[w]:
+                adverb = w[:-1] + u'i' if w.endswith(u'y') else w
+                adverb = adverb[:-2] if adverb.endswith(u'le') else adverb
+                entry = lexicon.setdefault(adverb + u'ly', {})
+                entry['RB'] = entry[None] = lexicon[w]['JJ']
+
+        # Word id 0 is unknown words and the last id is "!". Negations are
+        # in the vocabulary even when they are not in the lexicon.
+        words = sorted(set(lexicon) | set(NEGATIONS))
+        self.vocab = dict((w, i) for i, w in enumerate(words, 1))
+        self.bang = self.vocab[u'!'] = len(words) + 1
+        n = len(words) + 2
+        self.known = np.zeros(n, dtype=bool)
+        self.polarity = np.zeros(n)
+        self.intensity = np.ones(n)
+        self.modifier = np.zeros(n, dtype=bool)
+        self.negation = np.zeros(n, dtype=bool)
+        self.ly = np.zeros(n, dtype=bool)
+        for w in NEGATIONS:
+            self.negation[self.vocab[w]] = True
+        for w, entry in lexicon.items():
+            i = self.vocab[w]
+            self.polarity[i], self.intensity[i] = entry[None]
+            self.known[i] = True
+            self.modifier[i] = any(pos in entry for pos in MODIFIERS)
+            self.ly[i] = w.endswith(u'ly')
+
+    def tokenize(self, texts):
+        """
+        Word ids and lengths of all tokens of `texts`, and the index of the
+        text of each token
+        """
+        tokens, doc = [], []
+        for i, t in enumerate(texts):
+            # "don't" => "do n ' t", as pattern's tokenizer splits it
+            words = TOKEN.findall(t.lower().replace(u"n't", u" n't"))
+            tokens.extend(words)
+            doc.extend([i] * len(words))
+        uniques, inverse = np.unique(np.array(tokens, dtype=object),
+                                     return_inverse=True)
+        ids = np.array([self.vocab.get(w, 0) for w in uniques], dtype=int)
+        lengths = np.array([len(w.strip(u"'")) for w in uniques], dtype=int)
+        return ids[inverse], lengths[inverse], np.array(doc, dtype=int)
+
+    def score_many(self, texts):
+        """ Polarity of each text in `texts`, 0 for texts without words """
+        n_texts = len(texts)
+        ids, lengths, doc = self.tokenize(texts)
+        if not len(ids):
+            return np.zeros(n_texts)
+        pos = np.arange(len(ids))
+
+        def last_before(mask):
+            """ Last token before each token with `mask` in the same text """
+            last = np.maximum.accumulate(np.where(mask, pos, -1))
+            last = np.concatenate([[-1], last[:-1]])
+            last[doc[last] != doc] = -1
+            return last
+
+        known = self.known[ids]
+        negation = self.negation[ids]
+        # A negation holds until a lexicon word or a longer token, a
+        # modifier until a lexicon word or a token of three or more letters
+        m = last_before(known | ((lengths > 2) & ~negation))
+        modified = (m >= 0) & known[m] & self.modifier[ids[m]]
+        # A negation right after an "-ly" modifier negates the modifier
+        # instead ("really not good"), other negations end the modifier
+        to_modifier = negation & ~known & modified & self.ly[ids[m]]
+        m = last_before(known | ((lengths > 2) & ~to_modifier))
+        modified = (m >= 0) & known[m] & self.modifier[ids[m]]
+        k = last_before(known | negation | (lengths > 1))
+        negated = (k >= 0) & negation[k] & ~to_modifier[k]
+        merged = known & modified
+
+        polarity = self.polarity[ids]
+        intensity = np.where(negated, 1.0 / self.intensity[ids],
+                             self.intensity[ids])
+        polarity[merged] = np.clip(polarity[merged] *
+                                   intensity[m[merged]], -1.0, 1.0)
+
+        # One assessment per run of merged lexicon words, which takes the
+        # polarity of its last word
+        kpos = pos[known]
+        if not len(kpos):
+            return np.zeros(n_texts)
+        group = np.cumsum(~merged[kpos]) - 1
+        last = np.append(np.nonzero(np.diff(group))[0], len(kpos) - 1)
+        scores = polarity[kpos[last]]
+        token_group = np.full(len(ids), -1, dtype=int)
+        token_group[kpos] = group
+        group_negated = np.bincount(group, negated[kpos],
+                                    minlength=len(scores)) > 0
+        group_negated[token_group[m[to_modifier]]] = True
+        group_doc = doc[kpos[last]]
+
+        # "!" boosts the assessment it follows, unless a later word still
+        # joins that assessment
+        bang = ids == self.bang
+        k = last_before(known)[bang]
+        k = k[k >= 0]
+        boosted = token_group[k]
+        boosted = boosted[kpos[last][boosted] == k]
+        n_bangs = np.bincount(boosted, minlength=len(scores))
+        scores = np.clip(scores * 1.25 ** n_bangs, -1.0, 1.0)
+        scores = np.where(group_negated, -0.5 * scores, scores)
+
+        sums = np.bincount(group_doc, scores, minlength=n_texts)
+        counts = np.bincount(group_doc, minlength=n_texts)
+        return sums / np.maximum(counts, 1)
+
+
+SCORERS = {'textblob': TextBlobScorer,
+           'lexicon': LexiconScorer}
+
+
+class SentimentCache(object):
+    """
+    SQLite table of sentiment scores keyed by a hash of the scoring model
+    version and the review text, so a score is only computed once per text
+    and model. Connections are opened per process, so a cache can be handed
+    to worker processes.
+    """
+
+    def __init__(self, path, model=TEXTBLOB_MODEL):
+        self.path = path
+        self.model = model
+        self._conn = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_conn'] = state['_pid'] = None
+        return state
+
+    def _connect(self):
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60)
+            # Lets worker processes read while the driver writes
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS scores '
+                         '(key TEXT PRIMARY KEY, score REAL NOT NULL)')
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def key(self, text):
+        h = hashlib.sha1(self.model.encode('utf-8'))
+        h.update(b'\0')
+        h.update(text.encode('utf-8'))
+        return h.hexdigest()
+
+    def get(self, key):
+        row = self._connect().execute('SELECT score FROM scores WHERE key = ?',
+                                      (key,)).fetchone()
+        return row[0] if row else None
+
+    def put_many(self, scores):
+        """ Store a dict of key -> score """
+        conn = self._connect()
+        conn.executemany('INSERT OR REPLACE INTO scores VALUES (?, ?)',
+                         scores.items())
+        conn.commit()
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM scores'
+                                       ).fetchone()[0]
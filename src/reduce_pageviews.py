@@ -1,23 +1,45 @@
-""" Filter new hourly pageview count raw gzips and reduce to daily counts. """
+""" Filter new hourly pageview count raw gzips and reduce to daily counts.
+
+Run with spark-submit, which sets the master, e.g.
+
+    spark-submit --master local[4] reduce_pageviews.py --fused
+
+The executors import pagecounts, which is shipped to them with
+SparkContext.addPyFile, and NumPy, which has to be installed on every
+worker node.
+"""
 
 from __future__ import division
+import argparse
+from collections import defaultdict
 import csv
 import fnmatch
 import json
 import gzip
 import logging
 import os
+import shutil
+from StringIO import StringIO
 from time import time
 
 from pyspark import SparkContext
 
+from pagecounts import (TitleMatcher, ViewsMatrix, load_project_index,
+                        read_matching_lines)
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 RAW_PAGEVIEWS_FOLDER = "/Volumes/GitDocs/pageviews/other/pagecounts-raw/"
 CACHE_FILE = "../cache/pv/pageviews.gz"
+PROJECT_INDEX = "../cache/pv/project-index.json"
 COUNTS_FILE = "../cache/viewsperday.csv"
+COUNTS_FOLDER = "../cache/viewsperday/"
+MATRIX_FOLDER = "../cache/viewsmatrix/"
 WIKI_TITLES = "/Users/Rich/Documents/CS/EECS-E6895-ABDA/project/src/wiki_titles.json"
+# Modules imported by the executors
+PY_FILES = [os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'pagecounts.py')]
 
 
 def load_wiki_titles(path):
@@ -62,9 +84,16 @@ def gather_filepaths(folder, pattern='*'):
     return files
 
 
-def filter_raws(sc, titles):
+def filter_raws(sc, titles, sorted_input=False):
+    """
+    Parameters
+    ----------
+    sc : SparkContext
+    titles : list of article titles to keep
+    sorted_input : stop scanning each file after its 'en' block
+    """
     t0 = time()
-    prefixes = [u'en ' + t for t in titles]
+    matcher = TitleMatcher(titles)
 
     pattern = 'pagecounts-*.gz'
     files = gather_filepaths(RAW_PAGEVIEWS_FOLDER, pattern)
@@ -73,8 +102,8 @@ def filter_raws(sc, titles):
     for f in files.toLocalIterator():
         logger.info('Input: %s' % (os.path.basename(f)))
 
-    rdd = files.flatMap(read_fun_generator)
-    rdd = rdd.filter(lambda x: any([x.startswith(p) for p in prefixes]))
+    rdd = files.flatMap(lambda f: read_matching_lines(
+        f, matcher, sorted_input=sorted_input))
 
     folder = os.path.split(CACHE_FILE)[0]
     if not os.path.exists(folder):
@@ -109,6 +138,7 @@ def count_views(sc, path):
     rdd = sc.textFile(path)
     rdd = rdd.map(make_count_kv)
     rdd = rdd.reduceByKey(lambda x, y: x + y)
+    counts = []
     with open(COUNTS_FILE, 'wb') as fo:
         wr = csv.writer(fo)
         wr.writerow(['date', 'title', 'views'])
@@ -117,13 +147,94 @@ def count_views(sc, path):
             date, title = key.split('|')
             row = [date, title.encode('utf-8'), views]
             wr.writerow(row)
+            counts.append((date, title, views))
     logger.info('Saved: %s' % COUNTS_FILE)
+    ViewsMatrix.save(counts, MATRIX_FOLDER)
+    tf = (time() - t0) / 60
+    logger.info('--- %0.3f minutes ---' % tf)
+
+
+def format_count_row(kv):
+    """ Format a ('date|title', views) pair as a viewsperday.csv row """
+    key, views = kv
+    date, title = key.split('|')
+    buf = StringIO()
+    csv.writer(buf).writerow([date, title.encode('utf-8'), views])
+    return buf.getvalue().rstrip('\r\n').decode('utf-8')
+
+
+def count_raws(sc, titles, sorted_input=False, use_index=False):
+    """
+    Filter the raw files and reduce them to views per day in one Spark job.
+
+    Each partition filters its files with the broadcast matcher and sums
+    views per (date, title) locally before the shuffle, so no hourly line
+    passes through the driver. The executors write headerless
+    viewsperday.csv rows as part files under COUNTS_FOLDER, and the
+    driver collects the reduced counts into the ViewsMatrix store at
+    MATRIX_FOLDER. Unlike
+    filter_raws, input files are not deleted. Only the raw files currently
+    in RAW_PAGEVIEWS_FOLDER are counted, so keep every file the counts
+    should cover there. With `use_index`, the 'en' block offsets saved in
+    PROJECT_INDEX by filter_pagviews --checkpoint, which keeps its inputs,
+    are read (the index is not updated here).
+    """
+    t0 = time()
+    matcher = sc.broadcast(TitleMatcher(titles))
+    index = None
+    if use_index:
+        index = sc.broadcast(load_project_index(PROJECT_INDEX))
+
+    pattern = 'pagecounts-*.gz'
+    files = gather_filepaths(RAW_PAGEVIEWS_FOLDER, pattern)
+    logger.info('Processing %d files..' % len(files))
+
+    def count_partition(paths):
+        counts = defaultdict(int)
+        idx = index.value if index is not None else None
+        for path in paths:
+            lines = read_matching_lines(path, matcher.value,
+                                        sorted_input=sorted_input, index=idx)
+            for x in lines:
+                key, views = make_count_kv(x.decode('utf-8'))
+                counts[key] += views
+        return counts.items()
+
+    rdd = sc.parallelize(files, max(len(files), 1))
+    rdd = rdd.mapPartitions(count_partition)
+    rdd = rdd.reduceByKey(lambda x, y: x + y).cache()
+    if os.path.exists(COUNTS_FOLDER):
+        shutil.rmtree(COUNTS_FOLDER)
+    rdd.map(format_count_row).saveAsTextFile(COUNTS_FOLDER)
+    logger.info('Saved: %s' % COUNTS_FOLDER)
+    counts = (key.split('|') + [views]
+              for key, views in rdd.toLocalIterator())
+    ViewsMatrix.save(counts, MATRIX_FOLDER)
     tf = (time() - t0) / 60
     logger.info('--- %0.3f minutes ---' % tf)
 
 
 if __name__ == '__main__':
-    sc = SparkContext("local", "Reduce Pageviews")
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sorted', action='store_true',
+                        help='raw files are sorted by project code')
+    parser.add_argument('--index', action='store_true',
+                        help='use saved project offsets: ' + PROJECT_INDEX +
+                             ' (with --fused only)')
+    parser.add_argument('--fused', action='store_true',
+                        help='filter and count in one job into ' +
+                             COUNTS_FOLDER)
+    args = parser.parse_args()
+    if args.index and not args.fused:
+        parser.error('--index needs --fused, which keeps the inputs')
+    # The master is given by spark-submit --master
+    sc = SparkContext(appName="Reduce Pageviews")
+    for path in PY_FILES:
+        sc.addPyFile(path)
     titles = load_wiki_titles(WIKI_TITLES)
-    filter_raws(sc, titles)
-    count_views(sc, CACHE_FILE)
+    if args.fused:
+        count_raws(sc, titles, sorted_input=args.sorted,
+                   use_index=args.index)
+    else:
+        filter_raws(sc, titles, sorted_input=args.sorted)
+        count_views(sc, CACHE_FILE)
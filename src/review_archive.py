@@ -0,0 +1,234 @@
+""" Pack saved review pages into one indexed archive file.
+
+Run as a script to import a folder of saved pages,
+CACHE_FOLDER/<title>/<page>.html, into ARCHIVE. Pages already in the
+archive are skipped, so an interrupted import can be run again.
+"""
+
+from __future__ import division
+import argparse
+import json
+import logging
+import os
+import struct
+from time import time
+import zlib
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CACHE_FOLDER = '../cache/reviews/'
+ARCHIVE = '../cache/reviews.pack'
+
+# Record header: magic, title length, page number, data length
+HEADER = struct.Struct('<4sHII')
+# End of file: offset of the index record, magic
+TAIL = struct.Struct('<Q4s')
+PAGE = b'RVPG'
+INDEX = b'RVIX'
+END = b'RVAE'
+
+
+class ReviewArchive(object):
+    """
+    Review pages of all movies in one file, with random access by movie
+    title and page number.
+
+    The file is a sequence of page records, each a header, the UTF-8 title
+    and the zlib-compressed page, followed by an index record mapping
+    title and page to the offset and length of the compressed page, and a
+    tail pointing at the index record. Pages are appended over the index,
+    which is written again on `close`. If the index is missing, e.g. after
+    a crash while appending, it is rebuilt by scanning the page records.
+    Writing a page that is already in the archive appends a new record and
+    leaves the old one unused.
+    """
+
+    def __init__(self, path, mode='r'):
+        """
+        Parameters
+        ----------
+        path : archive file
+        mode : 'r' to read, 'a' to read and append, creating the file
+        """
+        if mode not in ('r', 'a'):
+            raise ValueError('Unsupported archive mode: %s' % mode)
+        self.path = path
+        self.mode = mode
+        self._fo = None
+        self._pid = None
+        self._dirty = False
+        if mode == 'a' and not os.path.exists(path):
+            open(path, 'wb').close()
+        self.index, self.end = self._load_index()
+
+    @staticmethod
+    def is_archive(path):
+        return os.path.isfile(path)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_fo'] = state['_pid'] = None
+        return state
+
+    def _file(self):
+        # One handle per process, so an archive can be handed to workers
+        if self._fo is None or self._pid != os.getpid():
+            self._fo = open(self.path, 'r+b' if self.mode == 'a' else 'rb')
+            self._pid = os.getpid()
+        return self._fo
+
+    def _load_index(self):
+        fo = self._file()
+        fo.seek(0, os.SEEK_END)
+        size = fo.tell()
+        if size >= TAIL.size:
+            fo.seek(size - TAIL.size)
+            offset, magic = TAIL.unpack(fo.read(TAIL.size))
+            if magic == END and offset + HEADER.size <= size:
+                fo.seek(offset)
+                magic, _, _, length = HEADER.unpack(fo.read(HEADER.size))
+                if (magic == INDEX and
+                        offset + HEADER.size + length + TAIL.size == size):
+                    entries = json.loads(zlib.decompress(fo.read(length)))
+                    index = {}
+                    for title, pages in entries.items():
+                        index[title] = dict((int(p), tuple(v))
+                                            for p, v in pages.items())
+                    return index, offset
+        if size:
+            logger.warning('No index in %s, scanning records' % self.path)
+        return self._scan(size)
+
+    def _scan(self, size):
+        """ Rebuild the index from the page records """
+        fo = self._file()
+        index = {}
+        offset = 0
+        fo.seek(0)
+        while offset + HEADER.size <= size:
+            magic, n_title, page, length = HEADER.unpack(fo.read(HEADER.size))
+            start = offset + HEADER.size + n_title
+            if magic != PAGE or start + length > size:
+                break
+            title = fo.read(n_title).decode('utf-8')
+            index.setdefault(title, {})[page] = (start, length)
+            fo.seek(length, os.SEEK_CUR)
+            offset = start + length
+        return index, offset
+
+    def titles(self):
+        return sorted(self.index)
+
+    def pages(self, title):
+        return sorted(self.index.get(title, {}))
+
+    def __contains__(self, key):
+        title, page = key
+        return page in self.index.get(title, {})
+
+    def __len__(self):
+        return sum(len(pages) for pages in self.index.values())
+
+    def __iter__(self):
+        """ (title, page) of all pages, by title and page number """
+        for title in self.titles():
+            for page in self.pages(title):
+                yield title, page
+
+    def read(self, title, page):
+        """ Page contents as bytes """
+        offset, length = self.index[title][page]
+        fo = self._file()
+        fo.seek(offset)
+        return zlib.decompress(fo.read(length))
+
+    def write(self, title, page, data):
+        """ Append the bytes `data` as page `page` of movie `title` """
+        if self.mode != 'a':
+            raise IOError('Archive is not open for appending: %s'
+                          % self.path)
+        raw_title = title.encode('utf-8')
+        compressed = zlib.compress(data)
+        fo = self._file()
+        fo.seek(self.end)
+        fo.write(HEADER.pack(PAGE, len(raw_title), page, len(compressed)))
+        fo.write(raw_title)
+        fo.write(compressed)
+        start = self.end + HEADER.size + len(raw_title)
+        self.index.setdefault(title, {})[page] = (start, len(compressed))
+        self.end = start + len(compressed)
+        self._dirty = True
+
+    def flush(self):
+        """ Write the index after the last page record """
+        if not self._dirty:
+            return
+        entries = dict((title, dict((str(p), v) for p, v in pages.items()))
+                       for title, pages in self.index.items())
+        compressed = zlib.compress(json.dumps(entries).encode('utf-8'))
+        fo = self._file()
+        fo.seek(self.end)
+        fo.write(HEADER.pack(INDEX, 0, 0, len(compressed)))
+        fo.write(compressed)
+        fo.write(TAIL.pack(self.end, END))
+        fo.truncate()
+        fo.flush()
+        os.fsync(fo.fileno())
+        self._dirty = False
+
+    def close(self):
+        if self._fo is not None and self._pid == os.getpid():
+            self.flush()
+            self._fo.close()
+        self._fo = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def import_folder(folder, archive):
+    """
+    Add the pages of `folder`/<title>/<page>.html missing from `archive`,
+    returning the number of pages added
+    """
+    n = 0
+    for title in sorted(os.listdir(folder)):
+        movie_folder = os.path.join(folder, title)
+        if not os.path.isdir(movie_folder):
+            continue
+        if isinstance(title, bytes):
+            title = title.decode('utf-8')
+        pages = []
+        for fn in os.listdir(movie_folder):
+            name, ext = os.path.splitext(fn)
+            if ext == '.html' and name.isdigit():
+                pages.append(int(name))
+        for page in sorted(pages):
+            if (title, page) in archive:
+                continue
+            with open(os.path.join(movie_folder, '%d.html' % page),
+                      'rb') as fi:
+                archive.write(title, page, fi.read())
+            n += 1
+        logger.info('Imported: %s (%d pages)' % (title, len(pages)))
+    return n
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('folder', nargs='?', default=CACHE_FOLDER,
+                        help='folder of saved pages')
+    parser.add_argument('archive', nargs='?', default=ARCHIVE,
+                        help='archive file to add the pages to')
+    args = parser.parse_args()
+    t0 = time()
+    with ReviewArchive(args.archive, 'a') as archive:
+        n = import_folder(args.folder, archive)
+        logger.info('Added %d pages, %d in: %s'
+                    % (n, len(archive), args.archive))
+    tf = (time() - t0) / 60
+    logger.info('--- %0.3f minutes ---' % tf)
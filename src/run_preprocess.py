@@ -1,19 +1,38 @@
-import cPickle
+""" Build the dataset from the cached data.
+
+Every stage result is cached under STAGES_FOLDER by a hash of its inputs,
+code and parameters, see stage_cache.StageCache, so a run only recomputes
+the stages affected by a change. The merges are cheap and always run.
+"""
+
 import logging
+from multiprocessing import cpu_count
 import os
 from time import time
 
 import pandas as pd
 
+from dataset import save_dataset
+import pagecounts
+from preprocess import imdb, movies, oscars, pagviews, sentiment
 from preprocess.oscars import Oscars
-from preprocess.imdb import Imdb, ImdbReviews
+from preprocess.imdb import ImdbReviews
+from preprocess.movies import Imdb
 from preprocess.pagviews import PageViews
+from preprocess.sentiment import SCORERS, SentimentCache
+import review_archive
+from stage_cache import StageCache
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__ if __name__ != '__main__' else [])
 
 DATA_FOLDER = '../data/'
 CACHE_FOLDER = '../cache/'
+STAGES_FOLDER = CACHE_FOLDER + 'stages/'
+DATASET = CACHE_FOLDER + 'dataset/'
+N_WORKERS = cpu_count()
+SCORER = 'textblob'
+WEIGHTED_REVIEWS = False
 
 
 def main():
@@ -21,29 +40,63 @@ def main():
 
     if not os.path.exists(CACHE_FOLDER):
         os.makedirs(CACHE_FOLDER)
-
-    oscars = Oscars(DATA_FOLDER + 'oscars/', CACHE_FOLDER)
-    oscars.preprocess()
-    lbls = oscars.get_labels()
-
-    imdb = Imdb(CACHE_FOLDER)
-    imdb_df = imdb.preprocess()
-
-    pv = PageViews(CACHE_FOLDER + 'viewsperday.csv', imdb_df)
-    pv_df = pv.preprocess()
-
-    rev = ImdbReviews(CACHE_FOLDER + 'reviews/', imdb_df)
-    rev_df = rev.preprocess(weighted=False)
+    stages = StageCache(STAGES_FOLDER)
+
+    def labels():
+        o = Oscars(DATA_FOLDER + 'oscars/', CACHE_FOLDER)
+        o.preprocess()
+        return o.get_labels()
+    lbls, lbls_key = stages.run(
+        'labels', labels, code=[oscars],
+        inputs=[DATA_FOLDER + 'oscars/' + oscars.RAW_FILENAME])
+
+    imdb_df, imdb_key = stages.run(
+        'imdb', Imdb(CACHE_FOLDER).preprocess, code=[movies],
+        inputs=[CACHE_FOLDER + 'imdb.csv'])
+
+    for pv_path in ['viewsmatrix/', 'viewsperday/', 'viewsperday.csv']:
+        pv_path = CACHE_FOLDER + pv_path
+        if os.path.exists(pv_path):
+            break
+    pv_df, pv_key = stages.run(
+        'pageviews', lambda: PageViews(pv_path, imdb_df).preprocess(),
+        code=[pagviews, pagecounts], deps=[imdb_key],
+        inputs=[pv_path, pagviews.CEREMONIES, pagviews.NOMINATIONS,
+                pagviews.WIKI_TITLES])
+
+    # Pages packed with review_archive.py, or the scraped folder
+    rev_path = CACHE_FOLDER + 'reviews.pack'
+    if not os.path.exists(rev_path):
+        rev_path = CACHE_FOLDER + 'reviews/'
+
+    def reviews():
+        cache = SentimentCache(CACHE_FOLDER + 'sentiment.db',
+                               model=SCORERS[SCORER].version)
+        rev = ImdbReviews(rev_path, imdb_df, sentiment_cache=cache,
+                          table_path=CACHE_FOLDER + 'reviews.npz')
+        return rev.preprocess(weighted=WEIGHTED_REVIEWS, n_workers=N_WORKERS,
+                              scorer=SCORER,
+                              source=stages.input_hash(rev_path))
+    rev_df, rev_key = stages.run(
+        'reviews', reviews, code=[imdb, sentiment, review_archive],
+        deps=[imdb_key], params={'scorer': SCORER,
+                                 'weighted': WEIGHTED_REVIEWS},
+        inputs=[rev_path, imdb.CEREMONIES_FILE, imdb.MOVIE_IDS_FILE])
 
     data = pd.DataFrame.merge(lbls, imdb_df, on='id')
     data = pd.DataFrame.merge(data, pv_df, on='id')
     data = pd.DataFrame.merge(data, rev_df, on='id')
     logger.info('data.shape = (%s, %s)' % data.shape)
 
-    out_file = CACHE_FOLDER + 'dataset.p'
-    with open(out_file, 'wb') as fo:
-        cPickle.dump(data, fo)
-    logger.info('Saved: %s' % out_file)
+    settings = {'pageviews': pv_path,
+                'pageview_features': [dict(f._asdict(), type=type(f).__name__)
+                                      for f in pagviews.DEFAULT_SPEC],
+                'reviews': rev_path,
+                'scorer': SCORERS[SCORER].version,
+                'weighted_reviews': WEIGHTED_REVIEWS,
+                'stages': {'labels': lbls_key, 'imdb': imdb_key,
+                           'pageviews': pv_key, 'reviews': rev_key}}
+    save_dataset(data, DATASET, settings)
 
     tf = (time() - t0) / 60
     logger.info('--- %0.3f minutes ---' % tf)
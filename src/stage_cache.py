@@ -0,0 +1,132 @@
+""" Content-hash cache for the results of pipeline stages """
+
+import cPickle
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def _hash_file(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as fi:
+        for chunk in iter(lambda: fi.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def module_hash(module):
+    """ Hash of the source of a module, its code version """
+    path = os.path.splitext(module.__file__)[0] + '.py'
+    return _hash_file(path)
+
+
+class StageCache(object):
+    """
+    Pickled stage results in `folder`, keyed by a hash of everything the
+    result depends on:
+
+        inputs  content hashes of input files and folders
+        code    source hashes of the modules implementing the stage
+        params  JSON-serializable stage parameters
+        deps    keys of the upstream stages whose results are used
+
+    plus the pandas and NumPy versions of the pickles. A stage is only run
+    if no result is saved under its key, and downstream stages depend on
+    its key rather than on its result, so a stage is rerun exactly when
+    something it depends on changed.
+
+    File hashes are memoized in `folder`/hashes.json by path, size and
+    modification time, so unchanged inputs are not read again.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.hashes_path = os.path.join(folder, 'hashes.json')
+        self.hashes = {}
+        if os.path.exists(self.hashes_path):
+            with open(self.hashes_path, 'r') as fi:
+                self.hashes = json.load(fi)
+
+    def file_hash(self, path):
+        st = os.stat(path)
+        path = os.path.abspath(path)
+        stamp = [st.st_size, st.st_mtime]
+        memo = self.hashes.get(path)
+        if memo is None or memo[:2] != stamp:
+            memo = self.hashes[path] = stamp + [_hash_file(path)]
+        return memo[2]
+
+    def input_hash(self, path):
+        """ Hash of a file, or of the names and contents of a folder """
+        if not os.path.isdir(path):
+            return self.file_hash(path)
+        h = hashlib.sha1()
+        for root, dirs, fns in os.walk(path):
+            dirs.sort()
+            for fn in sorted(fns):
+                p = os.path.join(root, fn)
+                h.update(os.path.relpath(p, path).encode('utf-8') + b'\0')
+                h.update(self.file_hash(p).encode('ascii'))
+        return h.hexdigest()
+
+    def save_hashes(self):
+        tmp_path = self.hashes_path + '.tmp'
+        with open(tmp_path, 'w') as fo:
+            json.dump(self.hashes, fo)
+        os.rename(tmp_path, self.hashes_path)
+
+    def key(self, name, inputs=(), code=(), params=None, deps=()):
+        desc = {'name': name,
+                'inputs': [self.input_hash(p) for p in inputs],
+                'code': [module_hash(m) for m in code],
+                'params': params,
+                'deps': list(deps),
+                'pandas': pd.__version__,
+                'numpy': np.__version__}
+        return hashlib.sha1(json.dumps(desc, sort_keys=True)).hexdigest()
+
+    def run(self, name, fun, inputs=(), code=(), params=None, deps=()):
+        """
+        Result and key of stage `name`, computed by calling `fun()` if no
+        result is saved under its key
+
+        Parameters
+        ----------
+        name : stage name
+        fun : function computing the stage result
+        inputs : paths of input files or folders
+        code : modules implementing the stage
+        params : JSON-serializable parameters of the stage
+        deps : keys of upstream stages
+        """
+        key = self.key(name, inputs, code, params, deps)
+        self.save_hashes()
+        path = os.path.join(self.folder, '%s-%s.p' % (name, key))
+        if os.path.exists(path):
+            logger.info('Stage %s unchanged, loading: %s' % (name, path))
+            with open(path, 'rb') as fi:
+                return cPickle.load(fi), key
+        logger.info('Running stage: %s' % name)
+        result = fun()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fo:
+            cPickle.dump(result, fo, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+        # Keep only the latest result of each stage
+        for fn in os.listdir(self.folder):
+            if (fn.startswith(name + '-') and fn.endswith('.p') and
+                    len(fn) == len(os.path.basename(path)) and
+                    fn != os.path.basename(path)):
+                os.remove(os.path.join(self.folder, fn))
+        logger.info('Saved: %s' % path)
+        return result, key
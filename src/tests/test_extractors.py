@@ -0,0 +1,40 @@
+""" The lxml review page extractor against the BeautifulSoup one """
+
+import os
+import unittest
+
+from preprocess.imdb import extract_reviews_lxml, extract_reviews_soup
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'fixtures')
+PAGES = [os.path.join(FIXTURES, 'reviews', 'Argo', '%d.html' % i)
+         for i in (1, 2)]
+
+
+def extract(extractor, page):
+    movie, reviews = extractor(page)
+    return movie, list(reviews)
+
+
+class ExtractorTest(unittest.TestCase):
+    def test_same_records(self):
+        for page in PAGES:
+            soup = extract(extract_reviews_soup, page)
+            lxml = extract(extract_reviews_lxml, page)
+            self.assertEqual(soup, lxml, page)
+
+    def test_fields(self):
+        movie, reviews = extract(extract_reviews_lxml, PAGES[1])
+        self.assertEqual(movie, u'Argo')
+        self.assertEqual(len(reviews), 3)
+        # Latin-1 page, header with votes and a rating image
+        self.assertEqual(reviews[0].title, u'Caf\xe9 & cinema')
+        self.assertEqual((reviews[0].votes, reviews[0].total), (0, 1))
+        self.assertIn(u'na\xefve', reviews[0].body)
+        # No helpful votes header
+        self.assertEqual((reviews[2].votes, reviews[2].total), (0, 0))
+        self.assertEqual(reviews[2].date, u'2 March 2013')
+
+
+if __name__ == '__main__':
+    unittest.main()
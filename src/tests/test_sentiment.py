@@ -0,0 +1,42 @@
+""" The lexicon sentiment scorer against TextBlob """
+
+import os
+import unittest
+
+from bench_sentiment import TOLERANCE
+from preprocess.sentiment import LexiconScorer, TextBlobScorer
+
+SENTENCES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'fixtures', 'sentences.txt')
+
+
+class LexiconScorerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with open(SENTENCES, 'rb') as fi:
+            cls.texts = [l.decode('utf-8').strip() for l in fi if l.strip()]
+        cls.lexicon = LexiconScorer().score_many(cls.texts)
+        cls.textblob = TextBlobScorer().score_many(cls.texts)
+
+    def test_within_tolerance(self):
+        for text, a, b in zip(self.texts, self.lexicon, self.textblob):
+            self.assertAlmostEqual(a, b, delta=TOLERANCE, msg=text)
+
+    def score(self, text):
+        return LexiconScorer().score_many([text])[0]
+
+    def test_negation(self):
+        self.assertLess(self.score(u'Not good.'), 0)
+        self.assertGreater(self.score(u'It was not bad at all.'), 0)
+        self.assertAlmostEqual(self.score(u"I don't like it."), 0)
+
+    def test_modifier(self):
+        self.assertGreater(self.score(u'A very good film.'),
+                           self.score(u'A good film.'))
+
+    def test_exclamation(self):
+        self.assertGreater(self.score(u'Amazing!'), self.score(u'Amazing.'))
+
+
+if __name__ == '__main__':
+    unittest.main()